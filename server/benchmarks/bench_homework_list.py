@@ -0,0 +1,119 @@
+import os
+import sys
+import logging
+import time
+import uuid
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+ROW_COUNTS = [10, 50, 200, 500]
+FILES_PER_HOMEWORK = 2
+RUNS = 20
+
+class CountingCursor:
+    def __init__(self, cursor, counter, operations=None):
+        self._cursor = cursor
+        self._counter = counter
+        self._operations = operations
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, operation, *args, **kwargs):
+        self._counter[0] += 1
+        if self._operations is not None:
+            self._operations.append(operation)
+        return self._cursor.execute(operation, *args, **kwargs)
+
+def install_query_counter():
+    counter = [0]
+    prepared = []
+
+    def cursor(self, *args, **kwargs):
+        operations = None
+        if kwargs.get('prepared'):
+            operations = []
+            prepared.append(operations)
+        return CountingCursor(self._conn.cursor(*args, **kwargs), counter, operations)
+
+    server.PooledConnection.cursor = cursor
+    return counter, prepared
+
+def check_prepared_reuse(prepared):
+    # mysql.connector re-prepares unless a prepared cursor is handed the very
+    # same SQL string object every time.
+    reprepared = sum(1 for operations in prepared if any(op is not operations[0] for op in operations))
+    assert not reprepared, f"{reprepared} prepared cursor(s) re-prepared their statement"
+    for name, stats in server.prepared_statements.snapshot().items():
+        assert stats['prepares'] <= server.db_pool.snapshot()['created'], (name, stats)
+
+def seed(conn, grade_class, token, rows):
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO verified_users (token, prs_id, device_name, full_name, grade_class)
+        VALUES (%s, %s, %s, %s, %s)
+    """, (token, 1, 'bench', 'Bench User', grade_class))
+    for i in range(rows):
+        cursor.execute("""
+            INSERT INTO custom_homework (author_prs_id, author_full_name, grade_class, subject, lesson_date, text)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (1, 'Bench User', grade_class, f'Subject {i % 12}', '2025-01-01', 'x' * 200))
+        homework_id = cursor.lastrowid
+        for j in range(FILES_PER_HOMEWORK):
+            cursor.execute("""
+                INSERT INTO custom_homework_files (homework_id, file_name, file_size, mime_type, storage_path)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (homework_id, f'file_{j}.pdf', 1024, 'application/pdf', '/dev/null'))
+    conn.commit()
+    cursor.close()
+
+def cleanup(conn, grade_class, token):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM custom_homework WHERE grade_class = %s", (grade_class,))
+    cursor.execute("DELETE FROM verified_users WHERE token = %s", (token,))
+    conn.commit()
+    cursor.close()
+
+def main():
+    server.logger.setLevel(logging.WARNING)
+    server.init_db()
+    counter, prepared = install_query_counter()
+    client = server.app.test_client()
+
+    print(f"{'rows':>6} {'queries':>8} {'p50 ms':>9} {'p95 ms':>9}")
+    for rows in ROW_COUNTS:
+        grade_class = f"bench-{uuid.uuid4().hex[:8]}"
+        token = str(uuid.uuid4())
+
+        conn = server.get_db_connection()
+        seed(conn, grade_class, token, rows)
+
+        try:
+            timings = []
+            queries = 0
+            for _ in range(RUNS):
+                server.token_cache.invalidate(token)
+                counter[0] = 0
+                start = time.perf_counter()
+                response = client.post('/custom-homework/list', json={'token': token})
+                timings.append((time.perf_counter() - start) * 1000)
+                queries = counter[0]
+                assert response.status_code == 200, response.get_data(as_text=True)
+
+            timings.sort()
+            p95 = timings[int(len(timings) * 0.95) - 1]
+            print(f"{rows:>6} {queries:>8} {statistics.median(timings):>9.2f} {p95:>9.2f}")
+        finally:
+            cleanup(conn, grade_class, token)
+            conn.close()
+
+    check_prepared_reuse(prepared)
+    print(f"{'statement':<28} {'prepares':>8} {'executions':>10}")
+    for name, stats in server.prepared_statements.snapshot().items():
+        print(f"{name:<28} {stats['prepares']:>8} {stats['executions']:>10}")
+
+if __name__ == '__main__':
+    main()
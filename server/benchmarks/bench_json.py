@@ -0,0 +1,84 @@
+import os
+import sys
+import logging
+import time
+import statistics
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+ENTRIES = 500
+FILES_PER_HOMEWORK = 2
+RUNS = 200
+
+def build_homework_list(entries):
+    created = datetime(2025, 1, 1, 8, 0, 0)
+    homework_list = []
+    for i in range(entries):
+        homework_list.append({
+            "id": i + 1,
+            "authorPrsId": 1000 + i % 30,
+            "authorFullName": f"Author {i % 30}",
+            "subject": f"Subject {i % 12}",
+            "lessonDate": date(2025, 1, 1) + timedelta(days=i % 180),
+            "text": "x" * 200,
+            "isMine": i % 30 == 0,
+            "files": [{
+                "id": i * FILES_PER_HOMEWORK + j,
+                "fileName": f"file_{j}.pdf",
+                "fileSize": 1024 * (j + 1),
+                "mimeType": "application/pdf"
+            } for j in range(FILES_PER_HOMEWORK)],
+            "createdAt": created + timedelta(minutes=i),
+            "updatedAt": created + timedelta(minutes=i, seconds=30)
+        })
+    return homework_list
+
+def with_isoformat(homework_list):
+    return [{
+        **hw,
+        "lessonDate": hw["lessonDate"].isoformat(),
+        "createdAt": hw["createdAt"].isoformat(),
+        "updatedAt": hw["updatedAt"].isoformat()
+    } for hw in homework_list]
+
+def measure(provider, build_payload):
+    server.app.json = provider
+    timings = []
+    size = 0
+    with server.app.app_context():
+        for _ in range(RUNS):
+            start = time.perf_counter()
+            response = server.jsonify({"homework": build_payload()})
+            timings.append((time.perf_counter() - start) * 1000)
+            size = len(response.get_data())
+    timings.sort()
+    return size, statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+def main():
+    server.logger.setLevel(logging.WARNING)
+    homework_list = build_homework_list(ENTRIES)
+    original_provider = server.app.json
+
+    cases = [
+        ("stdlib + isoformat", server.IsoJSONProvider(server.app), lambda: with_isoformat(homework_list)),
+        ("stdlib native dates", server.IsoJSONProvider(server.app), lambda: homework_list),
+    ]
+    if server.orjson is not None:
+        cases.append(("orjson native dates", server.OrjsonProvider(server.app), lambda: homework_list))
+    else:
+        print("orjson is not installed; skipping the orjson provider")
+
+    print(f"{ENTRIES} homework entries, {RUNS} runs")
+    print(f"{'provider':<22} {'bytes':>8} {'p50 ms':>9} {'p95 ms':>9}")
+    try:
+        for name, provider, build_payload in cases:
+            size, p50, p95 = measure(provider, build_payload)
+            print(f"{name:<22} {size:>8} {p50:>9.2f} {p95:>9.2f}")
+    finally:
+        server.app.json = original_provider
+
+if __name__ == '__main__':
+    main()
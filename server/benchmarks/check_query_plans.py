@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+CLASSES = 20
+HOMEWORK_PER_CLASS = 100
+FILES_PER_HOMEWORK = 2
+USERS_PER_CLASS = 25
+DEVICES_PER_USER = 2
+
+# EXPLAIN access types that read the whole table or the whole index.
+FULL_SCAN_TYPES = {'ALL', 'index'}
+
+class CapturingCursor:
+    def __init__(self, cursor, captured):
+        self._cursor = cursor
+        self._captured = captured
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, operation, params=()):
+        statement = ' '.join(operation.split())
+        if statement.split(' ', 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+            self._captured.setdefault(statement, tuple(params or ()))
+        return self._cursor.execute(operation, params)
+
+def install_query_capture():
+    captured = {}
+
+    def cursor(self, *args, **kwargs):
+        return CapturingCursor(self._conn.cursor(*args, **kwargs), captured)
+
+    server.PooledConnection.cursor = cursor
+    return captured
+
+def seed(conn, run_id):
+    cursor = conn.cursor()
+    grade_classes = [f"plan-{run_id}-{i}" for i in range(CLASSES)]
+    users = []
+    prs_id = 9_000_000
+    for grade_class in grade_classes:
+        for _ in range(USERS_PER_CLASS):
+            prs_id += 1
+            for device in range(DEVICES_PER_USER):
+                users.append((str(uuid.uuid4()), prs_id, f'plan device {device}', 'Plan User', grade_class))
+    cursor.executemany("""
+        INSERT INTO verified_users (token, prs_id, device_name, full_name, grade_class)
+        VALUES (%s, %s, %s, %s, %s)
+    """, users)
+
+    author = users[0]
+    homework = []
+    for grade_class in grade_classes:
+        for i in range(HOMEWORK_PER_CLASS):
+            homework.append((author[1], author[3], grade_class, f'Subject {i % 12}',
+                             (datetime(2025, 1, 1) + timedelta(days=i % 120)).date(), 'x' * 200))
+    cursor.executemany("""
+        INSERT INTO custom_homework (author_prs_id, author_full_name, grade_class, subject, lesson_date, text)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, homework)
+
+    format_strings = ','.join(['%s'] * len(grade_classes))
+    cursor.execute(f"SELECT id FROM custom_homework WHERE grade_class IN ({format_strings}) ORDER BY id", tuple(grade_classes))
+    homework_ids = [row[0] for row in cursor.fetchall()]
+
+    files = []
+    for homework_id in homework_ids:
+        for j in range(FILES_PER_HOMEWORK):
+            digest = uuid.uuid4().hex * 2
+            files.append((homework_id, f'file_{j}.pdf', 1024, 'application/pdf',
+                          server.attachment_store.path_for(digest), digest))
+    cursor.executemany("""
+        INSERT INTO custom_homework_files (homework_id, file_name, file_size, mime_type, storage_path, content_hash)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, files)
+
+    # Tombstone every other entry so the delta query has rows to choose from;
+    # the odd ones stay deletable by the workload.
+    cursor.executemany("""
+        INSERT INTO custom_homework_tombstones (homework_id, grade_class) VALUES (%s, %s)
+    """, [(homework_id, grade_classes[index // HOMEWORK_PER_CLASS])
+          for index, homework_id in enumerate(homework_ids) if index % 2 == 0])
+    conn.commit()
+
+    for table in ('verified_users', 'custom_homework', 'custom_homework_files', 'custom_homework_tombstones'):
+        cursor.execute(f"ANALYZE TABLE {table}")
+        cursor.fetchall()
+
+    cursor.execute("SELECT MIN(id) FROM custom_homework_files WHERE homework_id = %s", (homework_ids[1],))
+    file_id = cursor.fetchone()[0]
+    cursor.close()
+    return grade_classes, users, homework_ids, file_id
+
+def cleanup(conn, grade_classes):
+    cursor = conn.cursor()
+    format_strings = ','.join(['%s'] * len(grade_classes))
+    for table in ('custom_homework', 'custom_homework_tombstones', 'custom_homework_versions', 'verified_users'):
+        cursor.execute(f"DELETE FROM {table} WHERE grade_class IN ({format_strings})", tuple(grade_classes))
+    conn.commit()
+    cursor.close()
+
+def run_workload(client, users, homework_ids, file_id):
+    token = users[0][0]
+
+    responses = [
+        client.post('/custom-homework/list', json={'token': token}),
+        client.post('/custom-homework/list', json={'token': token, 'date_from': '2025-02-01', 'date_to': '2025-03-01'}),
+        client.post('/custom-homework/list', json={'token': token, 'since': (datetime.now() - timedelta(hours=1)).isoformat()}),
+    ]
+    page = client.post('/custom-homework/list', json={'token': token, 'limit': 10})
+    responses.append(page)
+    responses.append(client.post('/custom-homework/list', json={'token': token, 'cursor': page.json['nextCursor']}))
+
+    responses.append(client.get(f'/custom-homework/file/{file_id}?token={token}'))
+    responses.append(client.post('/list-devices', json={'token': token}))
+    responses.append(client.post('/check-verified-users', json={
+        'token': token, 'ids': sorted({user[1] for user in users})[:50]
+    }))
+
+    responses.append(client.post('/custom-homework/update', data={
+        'token': token,
+        'homework_id': str(homework_ids[1]),
+        'text': 'updated by the plan check',
+        'delete_file_ids': json.dumps([file_id])
+    }))
+    responses.append(client.post('/custom-homework/delete', json={'token': token, 'homework_id': homework_ids[3]}))
+
+    for response in responses:
+        if response.status_code >= 500:
+            raise RuntimeError(f"{response.request.path} failed: {response.get_data(as_text=True)}")
+
+def explain(conn, statement, params):
+    cursor = conn._conn.cursor()
+    cursor.execute(f"EXPLAIN {statement}", params)
+    columns = cursor.column_names
+    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    cursor.close()
+    return rows
+
+def main():
+    server.logger.setLevel(logging.WARNING)
+    server.init_db()
+    # Only the request path is checked; skip the eSchool login and indexer.
+    server.worker_pid = os.getpid()
+
+    run_id = uuid.uuid4().hex[:8]
+    conn = server.get_db_connection()
+    grade_classes, users, homework_ids, file_id = seed(conn, run_id)
+
+    failures = 0
+    try:
+        captured = install_query_capture()
+        run_workload(server.app.test_client(), users, homework_ids, file_id)
+
+        print(f"{len(captured)} distinct statements")
+        for statement, params in captured.items():
+            plan = explain(conn, statement, params)
+            scans = [row for row in plan if row.get('type') in FULL_SCAN_TYPES]
+            failures += bool(scans)
+            print(f"{'FULL SCAN' if scans else 'ok':<10} {statement[:110]}")
+            for row in plan:
+                print(f"{'':<12}{row.get('table')}: type={row.get('type')} key={row.get('key')} rows={row.get('rows')} {row.get('Extra') or ''}")
+    finally:
+        cleanup(conn, grade_classes)
+        conn.close()
+
+    if failures:
+        print(f"{failures} statement(s) fall back to a full scan")
+        sys.exit(1)
+    print("No full scans")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+# gunicorn -c gunicorn.conf.py
+#
+# The app is preloaded: schema migrations run once in the master, and
+# workers reset sockets/pools after fork (see server.reinitialize_after_fork).
+# Each worker then starts its background threads in post_worker_init: the
+# eSchool login runs in SessionManager.bootstrap (serialised across workers
+# by a MySQL lock), and one elected worker runs the inbox indexer and the
+# session keepalive.
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+wsgi_app = "server:create_app()"
+bind = os.getenv("BIND", "0.0.0.0:20001")
+workers = int(os.getenv("WEB_WORKERS") or multiprocessing.cpu_count())
+threads = int(os.getenv("WEB_THREADS", "8"))
+worker_class = "gevent" if os.getenv("ASYNC_MODE", "").lower() == "gevent" else "gthread"
+worker_connections = int(os.getenv("WEB_WORKER_CONNECTIONS", "1000"))
+preload_app = os.getenv("WEB_PRELOAD", "true").lower() == "true"
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+accesslog = None
+
+def post_worker_init(worker):
+    import server
+    server.start_worker()
@@ -1,28 +1,111 @@
 import os
+
+# Cooperative serving mode: every socket wait (eSchool calls, MySQL, clients)
+# yields to other greenlets instead of pinning a thread. Must run before
+# anything else imports socket/threading, so it is read from the process
+# environment rather than .env.
+ASYNC_MODE = os.getenv("ASYNC_MODE", "").lower()
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 import sys
 import json
 import hashlib
+import math
+import re
+import atexit
+import gzip
+import base64
+import fcntl
+import queue
+import logging
 import random
 import string
 import requests
+import tempfile
 import time
 import uuid
 import threading
-from collections import defaultdict
+from datetime import date, datetime, timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from contextlib import contextmanager
+from urllib.parse import quote
+from logging.handlers import QueueHandler, QueueListener
 import mysql.connector
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Request, g, jsonify, request, send_file
+from flask.json.provider import DefaultJSONProvider, JSONProvider
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 from functools import wraps
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
+JSON_PROVIDER = os.getenv("JSON_PROVIDER", "orjson" if orjson is not None else "default").lower()
+
+class IsoJSONProvider(DefaultJSONProvider):
+    """Flask's stdlib provider, but dates go out as ISO 8601 like orjson's."""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, (date, datetime)):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+class OrjsonProvider(JSONProvider):
+    """orjson-backed provider with native date/datetime serialization.
+
+    Unlike the stdlib provider (ensure_ascii=True), non-ASCII text such as
+    Cyrillic names and subjects is written as raw UTF-8 rather than \\uXXXX
+    escapes: the JSON is equivalent, and about half the size for those fields.
+    """
+
+    options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+    @staticmethod
+    def _default(o):
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self._default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self._default, option=self.options),
+            mimetype='application/json'
+        )
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app) if JSON_PROVIDER == 'orjson' and orjson is not None else IsoJSONProvider(app)
 
 class RateLimiter:
-    def __init__(self):
-        self.requests = defaultdict(list)
-        self.lock = threading.Lock()
+    def __init__(self, shards=16, max_keys=100000, sweep_interval=60):
+        self.shards = [OrderedDict() for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.last_sweep = [time.monotonic()] * shards
+        self.evictions = [0] * shards
+        self.max_keys_per_shard = max(1, max_keys // shards)
+        self.sweep_interval = sweep_interval
 
         self.limits = {
             'verification': {'requests': 5, 'window': 300},
@@ -31,35 +114,285 @@ class RateLimiter:
             'default': {'requests': 60, 'window': 60},
         }
 
-    def _clean_old_requests(self, ip, window):
-        now = time.time()
-        self.requests[ip] = [t for t in self.requests[ip] if now - t < window]
+    def _shard_index(self, key):
+        return hash(key) % len(self.shards)
+
+    def _sweep(self, index, now):
+        shard = self.shards[index]
+        idle = [key for key, entry in shard.items() if now >= entry[0] + 2 * entry[3]]
+        for key in idle:
+            del shard[key]
+        self.evictions[index] += len(idle)
+        self.last_sweep[index] = now
+
+    def _roll(self, entry, now):
+        window = entry[3]
+        window_start = now - (now % window)
+        if entry[0] != window_start:
+            entry[2] = entry[1] if window_start - entry[0] == window else 0
+            entry[1] = 0
+            entry[0] = window_start
+
+    def _entry(self, index, key, window, now):
+        shard = self.shards[index]
+        if now - self.last_sweep[index] >= self.sweep_interval:
+            self._sweep(index, now)
+
+        entry = shard.get(key)
+        if entry is None:
+            entry = self._new_entry(now, window)
+            shard[key] = entry
+            while len(shard) > self.max_keys_per_shard:
+                shard.popitem(last=False)
+                self.evictions[index] += 1
+        else:
+            shard.move_to_end(key)
+            self._roll(entry, now)
+        return entry
+
+    def _new_entry(self, now, window):
+        return [now - (now % window), 0, 0, window]
+
+    def _counts(self, entry):
+        return entry[1], entry[2]
+
+    def _estimate(self, entry, now):
+        window_start, window = entry[0], entry[3]
+        current, previous = self._counts(entry)
+        return previous * (window - (now - window_start)) / window + current
+
+    def _on_request(self, key, entry, allowed):
+        pass
 
     def is_allowed(self, ip, limit_type='default'):
         limit = self.limits.get(limit_type, self.limits['default'])
         max_requests = limit['requests']
         window = limit['window']
 
-        with self.lock:
-            self._clean_old_requests(ip, window)
-
-            if len(self.requests[ip]) >= max_requests:
-                return False
+        key = (ip, limit_type)
+        index = self._shard_index(key)
+        now = time.time()
 
-            self.requests[ip].append(time.time())
-            return True
+        with self.locks[index]:
+            entry = self._entry(index, key, window, now)
+            allowed = self._estimate(entry, now) < max_requests
+            if allowed:
+                entry[1] += 1
+            self._on_request(key, entry, allowed)
+            return allowed
 
     def get_retry_after(self, ip, limit_type='default'):
         limit = self.limits.get(limit_type, self.limits['default'])
+        max_requests = limit['requests']
         window = limit['window']
 
-        with self.lock:
-            if not self.requests[ip]:
+        key = (ip, limit_type)
+        index = self._shard_index(key)
+        now = time.time()
+
+        with self.locks[index]:
+            entry = self.shards[index].get(key)
+            if entry is None:
                 return 0
-            oldest = min(self.requests[ip])
-            return max(0, int(window - (time.time() - oldest)))
+            self._roll(entry, now)
+            if self._estimate(entry, now) < max_requests:
+                return 0
+
+            window_start = entry[0]
+            current, previous = self._counts(entry)
+            if current < max_requests:
+                unblock_at = window_start + window * (1 - (max_requests - current) / previous)
+            else:
+                unblock_at = window_start + window + window * (1 - max_requests / current)
+            return max(1, math.ceil(unblock_at - now))
+
+    def snapshot(self):
+        keys = 0
+        for index, lock in enumerate(self.locks):
+            with lock:
+                keys += len(self.shards[index])
+        return {
+            'keys': keys,
+            'max_keys': self.max_keys_per_shard * len(self.shards),
+            'shards': len(self.shards),
+            'evictions': sum(self.evictions),
+        }
 
-rate_limiter = RateLimiter()
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter whose counts are shared through the rate_limit_counters table.
+
+    Decisions stay local and lock-striped; a background thread flushes the
+    accumulated per-(key, window) deltas in one multi-row upsert every
+    sync_interval and reads back the global totals for keys seen since the
+    last sync. Entries carry the global counts alongside the unflushed local
+    ones, so all workers and hosts converge on one budget with at most one
+    sync interval of over-admission. If the database is unavailable the
+    deltas are kept and limits are enforced per process meanwhile.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, shards=16, max_keys=100000, sweep_interval=60, sync_interval=1.0):
+        super().__init__(shards, max_keys, sweep_interval)
+        self.sync_interval = sync_interval
+        self.pending_lock = threading.Lock()
+        self.pending = {}
+        self.touched = set()
+        self.last_purge = time.time()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.sync_stats = {
+            'syncs': 0,
+            'failures': 0,
+            'rows_flushed': 0,
+            'keys_refreshed': 0,
+            'last_sync_ms': 0.0,
+        }
+
+    def _new_entry(self, now, window):
+        return [now - (now % window), 0, 0, window, 0, 0]
+
+    def _counts(self, entry):
+        return entry[1] + entry[4], entry[2] + entry[5]
+
+    def _roll(self, entry, now):
+        window = entry[3]
+        window_start = now - (now % window)
+        if entry[0] != window_start:
+            consecutive = window_start - entry[0] == window
+            entry[5] = entry[4] if consecutive else 0
+            entry[4] = 0
+        super()._roll(entry, now)
+
+    def _on_request(self, key, entry, allowed):
+        with self.pending_lock:
+            self.touched.add(key)
+            if allowed:
+                pending_key = (key, int(entry[0]))
+                self.pending[pending_key] = self.pending.get(pending_key, 0) + 1
+
+    @staticmethod
+    def _store_key(key):
+        ip, limit_type = key
+        return f"{limit_type}:{ip}"[:191]
+
+    def start(self):
+        if self.sync_interval <= 0 or (self.thread and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="rate-limit-sync", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        while not self.stop_event.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                self.sync_stats['failures'] += 1
+                log(f"Rate limit sync failed: {e}", logging.WARNING)
+
+    def sync(self):
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+            touched, self.touched = self.touched, set()
+        if not pending and not touched:
+            return
+
+        start = time.monotonic()
+        conn = get_db_connection()
+        if not conn:
+            self._requeue(pending, touched)
+            raise RuntimeError("no database connection")
+
+        try:
+            cursor = conn.cursor()
+            rows = [(self._store_key(key), window_start, count) for (key, window_start), count in pending.items()]
+            for i in range(0, len(rows), self.BATCH_SIZE):
+                batch = rows[i:i + self.BATCH_SIZE]
+                cursor.execute(
+                    "INSERT INTO rate_limit_counters (limit_key, window_start, count) VALUES "
+                    + ", ".join(["(%s, %s, %s)"] * len(batch))
+                    + " ON DUPLICATE KEY UPDATE count = count + VALUES(count)",
+                    [value for row in batch for value in row]
+                )
+            conn.commit()
+        except Exception:
+            conn.close()
+            self._requeue(pending, touched)
+            raise
+
+        try:
+            totals = {}
+            keys = {self._store_key(key): key for key in touched}
+            oldest = int(time.time()) - 2 * max(limit['window'] for limit in self.limits.values())
+            store_keys = list(keys)
+            for i in range(0, len(store_keys), self.BATCH_SIZE):
+                batch = store_keys[i:i + self.BATCH_SIZE]
+                cursor.execute(
+                    "SELECT limit_key, window_start, count FROM rate_limit_counters WHERE window_start >= %s AND limit_key IN ("
+                    + ", ".join(["%s"] * len(batch)) + ")",
+                    [oldest, *batch]
+                )
+                for store_key, window_start, count in cursor.fetchall():
+                    totals[(keys[store_key], int(window_start))] = int(count)
+            conn.commit()
+
+            if time.time() - self.last_purge >= self.sweep_interval:
+                cursor.execute("DELETE FROM rate_limit_counters WHERE window_start < %s", (oldest,))
+                conn.commit()
+                self.last_purge = time.time()
+            cursor.close()
+        finally:
+            conn.close()
+
+        self._apply(touched, pending, totals)
+        self.sync_stats['syncs'] += 1
+        self.sync_stats['rows_flushed'] += len(pending)
+        self.sync_stats['keys_refreshed'] += len(touched)
+        self.sync_stats['last_sync_ms'] = round((time.monotonic() - start) * 1000, 2)
+
+    def _requeue(self, pending, touched):
+        with self.pending_lock:
+            for pending_key, count in pending.items():
+                self.pending[pending_key] = self.pending.get(pending_key, 0) + count
+            self.touched |= touched
+
+    def _apply(self, touched, flushed, totals):
+        now = time.time()
+        for key in touched:
+            index = self._shard_index(key)
+            with self.locks[index]:
+                entry = self.shards[index].get(key)
+                if entry is None:
+                    continue
+                self._roll(entry, now)
+                window_start, window = int(entry[0]), entry[3]
+                previous_start = window_start - window
+                entry[1] = max(0, entry[1] - flushed.get((key, window_start), 0))
+                entry[2] = max(0, entry[2] - flushed.get((key, previous_start), 0))
+                entry[4] = totals.get((key, window_start), entry[4])
+                entry[5] = totals.get((key, previous_start), entry[5])
+
+    def snapshot(self):
+        stats = super().snapshot()
+        with self.pending_lock:
+            stats['pending'] = len(self.pending)
+        stats['sync'] = dict(self.sync_stats)
+        return stats
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_SWEEP_INTERVAL = int(os.getenv("RATE_LIMIT_SWEEP_INTERVAL", "60"))
+RATE_LIMIT_SYNC_INTERVAL = float(os.getenv("RATE_LIMIT_SYNC_INTERVAL", "1"))
+
+if RATE_LIMIT_BACKEND == 'mysql':
+    rate_limiter = SharedRateLimiter(RATE_LIMIT_SHARDS, RATE_LIMIT_MAX_KEYS, RATE_LIMIT_SWEEP_INTERVAL, RATE_LIMIT_SYNC_INTERVAL)
+else:
+    rate_limiter = RateLimiter(RATE_LIMIT_SHARDS, RATE_LIMIT_MAX_KEYS, RATE_LIMIT_SWEEP_INTERVAL)
 
 def rate_limit(limit_type='default'):
     def decorator(f):
@@ -71,7 +404,7 @@ def rate_limit(limit_type='default'):
 
             if not rate_limiter.is_allowed(ip, limit_type):
                 retry_after = rate_limiter.get_retry_after(ip, limit_type)
-                log(f"Rate limit exceeded for {ip} on {limit_type}")
+                log(f"Rate limit exceeded for {ip} on {limit_type}", logging.WARNING)
                 response = jsonify({
                     'error': 'Too many requests',
                     'retry_after': retry_after
@@ -83,41 +416,128 @@ def rate_limit(limit_type='default'):
         return wrapper
     return decorator
 
-def log(message):
-    print(message, flush=True)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+LOG_ROUTE_SAMPLE_RATES = {
+    route.strip(): float(rate)
+    for route, _, rate in (item.partition('=') for item in os.getenv("LOG_ROUTE_SAMPLE_RATES", "").split(',') if item.strip())
+}
+LOG_REQUEST_BODIES = os.getenv("LOG_REQUEST_BODIES", "false").lower() == "true"
+LOG_RESPONSE_BODIES = os.getenv("LOG_RESPONSE_BODIES", "false").lower() == "true"
+LOG_BODY_MAX_BYTES = int(os.getenv("LOG_BODY_MAX_BYTES", "2000"))
+
+REDACTED_HEADERS = {'authorization', 'cookie', 'set-cookie', 'x-metrics-token'}
+REDACTED_FIELDS_RE = re.compile(r'("(?:token|password|code)"\s*:\s*)"[^"]*"')
+REDACTED_PARAMS_RE = re.compile(r'((?:^|[?&])(?:token|password|code)=)[^&]*')
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+logger = logging.getLogger("reschool")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+log_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+logger.addHandler(log_handler)
+
+log_stream_handler = logging.StreamHandler(sys.stdout)
+log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+log_listener = None
+log_listener_pid = None
+
+def start_log_listener():
+    global log_listener, log_listener_pid
+    log_listener_pid = os.getpid()
+    log_listener = QueueListener(log_handler.queue, log_stream_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+start_log_listener()
+
+def log(message, level=logging.INFO):
+    logger.log(level, message)
+
+def redact(text):
+    return REDACTED_FIELDS_RE.sub(r'\1"[REDACTED]"', text)
+
+def format_body(text):
+    text = redact(text)
+    if len(text) > LOG_BODY_MAX_BYTES:
+        return f"{text[:LOG_BODY_MAX_BYTES]}... [Truncated, {len(text)} bytes]"
+    return text
+
+def format_headers(headers):
+    return ', '.join(
+        f"{key}: {'[HIDDEN]' if key.lower() in REDACTED_HEADERS else value}"
+        for key, value in headers.items()
+    )
+
+def request_sample_rate():
+    route = request.url_rule.rule if request.url_rule else request.path
+    return LOG_ROUTE_SAMPLE_RATES.get(route, LOG_SAMPLE_RATE)
 
 @app.before_request
 def log_incoming_request():
-    log("\n========== INCOMING REQUEST ==========")
-    log(f"URL: {request.url}")
-    log(f"Method: {request.method}")
-    log("Headers:")
-    for key, value in request.headers.items():
-        log(f"  {key}: {value}")
-
-    if request.is_json:
-        log(f"Body: {json.dumps(request.json)}")
-    elif request.form:
-        log(f"Body (Form): {request.form.to_dict()}")
-    elif request.data:
-        log(f"Body (Raw): {request.data.decode('utf-8', errors='ignore')}")
-    else:
-        log("Body: [empty]")
-    log("======================================\n")
+    g.request_started = time.monotonic()
+    g.log_sampled = random.random() < request_sample_rate()
+
+    if not g.log_sampled or not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    log(f"Request headers: {format_headers(request.headers)}", logging.DEBUG)
+    if LOG_REQUEST_BODIES:
+        if request.is_json:
+            log(f"Request body: {format_body(request.get_data(as_text=True))}", logging.DEBUG)
+        elif request.form:
+            log(f"Request body (form): {format_body(json.dumps(request.form.to_dict()))}", logging.DEBUG)
 
 @app.after_request
 def log_outgoing_response(response):
-    log("\n========== OUTGOING RESPONSE ==========")
-    log(f"Status Code: {response.status_code}")
-    if response.is_json:
-        log(f"Response Body: {response.get_data(as_text=True)}")
-    else:
-        log("Response Body: [Not JSON]")
-    log("=======================================\n")
+    sampled = g.get('log_sampled', True)
+    if not sampled and response.status_code < 500:
+        return response
+
+    elapsed_ms = (time.monotonic() - g.get('request_started', time.monotonic())) * 1000
+    path = REDACTED_PARAMS_RE.sub(r'\1[REDACTED]', request.full_path.rstrip('?'))
+    level = logging.ERROR if response.status_code >= 500 else logging.INFO
+    log(f"{request.method} {path} {response.status_code} {elapsed_ms:.1f}ms", level)
+
+    if LOG_RESPONSE_BODIES and response.is_json and not response.direct_passthrough and not response.content_encoding and logger.isEnabledFor(logging.DEBUG):
+        log(f"Response body: {format_body(response.get_data(as_text=True))}", logging.DEBUG)
     return response
 
 BASE_URL = "https://app.eschool.center/ec-server"
 USER_AGENT = "eSchoolMobile"
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "50" if ASYNC_MODE == 'gevent' else "10"))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "15"))
+UPSTREAM_WORKERS = int(os.getenv("UPSTREAM_WORKERS", "256" if ASYNC_MODE == 'gevent' else "8"))
+DEEP_SCAN_THREADS = int(os.getenv("DEEP_SCAN_THREADS", "5"))
+VERIFICATION_DEADLINE = float(os.getenv("VERIFICATION_DEADLINE", "20"))
+SESSION_KEEPALIVE_INTERVAL = float(os.getenv("SESSION_KEEPALIVE_INTERVAL", "600"))
+LOGIN_LOCK_TIMEOUT = int(os.getenv("LOGIN_LOCK_TIMEOUT", "60"))
+LOGIN_RETRY_MIN_DELAY = float(os.getenv("LOGIN_RETRY_MIN_DELAY", "5"))
+LOGIN_RETRY_MAX_DELAY = float(os.getenv("LOGIN_RETRY_MAX_DELAY", "300"))
+INBOX_POLL_INTERVAL = float(os.getenv("INBOX_POLL_INTERVAL", "5"))
+INBOX_POLL_THREADS = int(os.getenv("INBOX_POLL_THREADS", "20"))
+POLLER_ELECTION_INTERVAL = float(os.getenv("POLLER_ELECTION_INTERVAL", "10"))
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", "10"))
+CHAT_MAX_ROWS = int(os.getenv("CHAT_MAX_ROWS", "50"))
+VERIFICATION_CODE_TTL = int(os.getenv("VERIFICATION_CODE_TTL", "900"))
+VERIFICATION_INDEX_SIZE = int(os.getenv("VERIFICATION_INDEX_SIZE", "10000"))
+UPSTREAM_CACHE_TTL = float(os.getenv("UPSTREAM_CACHE_TTL", "3"))
+UPSTREAM_CACHE_SIZE = int(os.getenv("UPSTREAM_CACHE_SIZE", "1000"))
+
+VERIFICATION_CODE_LENGTH = 16
+VERIFICATION_CODE_RE = re.compile(r'[A-Z0-9]{%d,}' % VERIFICATION_CODE_LENGTH)
 
 CURRENT_COOKIES = None
 MY_PRS_ID = None
@@ -126,17 +546,443 @@ DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_USER = os.getenv("DB_USER", "user")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
 DB_NAME = os.getenv("DB_NAME", "reschool")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_MAX_LIFETIME = int(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+DB_POOL_PING_INTERVAL = int(os.getenv("DB_POOL_PING_INTERVAL", "30"))
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "300"))
+TOKEN_REVOCATION_CHECK_INTERVAL = float(os.getenv("TOKEN_REVOCATION_CHECK_INTERVAL", "1"))
+
+HOMEWORK_TOMBSTONE_RETENTION_DAYS = int(os.getenv("HOMEWORK_TOMBSTONE_RETENTION_DAYS", "30"))
+HOMEWORK_PAGE_SIZE = int(os.getenv("HOMEWORK_PAGE_SIZE", "100"))
+HOMEWORK_MAX_PAGE_SIZE = int(os.getenv("HOMEWORK_MAX_PAGE_SIZE", "200"))
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads', 'custom_homework')
 MAX_FILE_SIZE = 50 * 1024 * 1024
 MAX_FILES_PER_HOMEWORK = 3
 ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'jpg', 'jpeg', 'png', 'gif', 'txt', 'zip', 'rar'}
+UPLOAD_STAGING_FOLDER = os.path.join(UPLOAD_FOLDER, '.incoming')
+# mkstemp creates 0600 files and os.replace keeps the mode; stored blobs get
+# the umask default (like file.save did) so a proxy serving them via
+# X-Accel-Redirect/X-Sendfile as another user can read them.
+_umask = os.umask(0)
+os.umask(_umask)
+UPLOAD_FILE_MODE = 0o666 & ~_umask
+ATTACHMENT_STORE_FOLDER = os.path.join(UPLOAD_FOLDER, 'objects')
+MAX_REQUEST_OVERHEAD = int(os.getenv("MAX_REQUEST_OVERHEAD", str(1024 * 1024)))
+FILE_OFFLOAD_MODE = os.getenv("FILE_OFFLOAD_MODE", "").lower()
+FILE_OFFLOAD_PREFIX = os.getenv("FILE_OFFLOAD_PREFIX", "/protected-uploads/")
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(UPLOAD_STAGING_FOLDER, exist_ok=True)
+os.makedirs(ATTACHMENT_STORE_FOLDER, exist_ok=True)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+class StreamedUpload:
+    """Multipart file part written straight to the staging folder.
+
+    The SHA-256 and size are computed while the parser writes, so a part
+    that grows past MAX_FILE_SIZE is dropped mid-stream instead of being
+    buffered and measured afterwards. Accepted parts are hard-linked into
+    place with link(); the staged copy is removed on close().
+    """
+
+    def __init__(self, filename, accepted, max_size):
+        self.filename = filename
+        self.accepted = accepted
+        self.max_size = max_size
+        self.size = 0
+        self.oversized = False
+        self.hasher = hashlib.sha256()
+        self.path = None
+        self.file = None
+        if accepted:
+            fd, self.path = tempfile.mkstemp(dir=UPLOAD_STAGING_FOLDER)
+            os.fchmod(fd, UPLOAD_FILE_MODE)
+            self.file = os.fdopen(fd, 'w+b')
+
+    @property
+    def usable(self):
+        return self.accepted and not self.oversized
+
+    @property
+    def sha256(self):
+        return self.hasher.hexdigest()
+
+    def write(self, data):
+        if not self.usable:
+            return len(data)
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.oversized = True
+            self._discard()
+            return len(data)
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def _discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+    def link(self, final_path):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        os.link(self.path, final_path)
+
+    def read(self, size=-1):
+        return self.file.read(size) if self.file is not None else b''
+
+    def readline(self, size=-1):
+        return self.file.readline(size) if self.file is not None else b''
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence) if self.file is not None else 0
+
+    def tell(self):
+        return self.file.tell() if self.file is not None else self.size
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        self._discard()
+
+class UploadRequest(Request):
+    """Streams multipart files through StreamedUpload.
+
+    Parts with a disallowed extension, and parts beyond the per-homework
+    file limit, are accepted by the parser but never touch the disk.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Only parts that are staged count towards the limit, so a rejected
+        # file doesn't take the slot of a valid one after it.
+        upload_count = getattr(self, 'upload_count', 0)
+        accepted = bool(filename) and allowed_file(filename) and upload_count < MAX_FILES_PER_HOMEWORK
+        if content_length and content_length > MAX_FILE_SIZE:
+            accepted = False
+        if accepted:
+            self.upload_count = upload_count + 1
+        return StreamedUpload(filename, accepted, MAX_FILE_SIZE)
+
+class AttachmentStore:
+    """Content-addressed storage for homework attachments.
+
+    Blobs live under root/<aa>/<bb>/<sha256>; every custom_homework_files
+    row carrying that content_hash is one reference. Blobs are placed
+    before the referencing rows are committed, so a failed write rolls the
+    rows back and leaves at most an unreferenced blob, and settled again
+    afterwards in case a concurrent release() removed the blob before the
+    rows became visible. Blobs are removed only once no row references
+    them. Placing and moving blobs happens under a per-prefix
+    flock so concurrent workers cannot drop a blob that a new row has just
+    started pointing at; no query runs while the flock is held.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock_dir = os.path.join(root, '.locks')
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.stats_lock = threading.Lock()
+        self.prefix_locks = {}
+        self.stored = 0
+        self.deduplicated = 0
+        self.removed = 0
+        self.bytes_stored = 0
+        self.bytes_deduplicated = 0
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    @contextmanager
+    def _locked(self, digest):
+        prefix = digest[:2]
+        # The process-local lock (cooperative under gevent) queues threads and
+        # greenlets of this worker; the flock only arbitrates between workers.
+        with self.prefix_locks.setdefault(prefix, threading.Lock()):
+            with open(os.path.join(self.lock_dir, prefix), 'a') as lock_file:
+                if ASYNC_MODE == 'gevent':
+                    # A blocking flock would stall the hub; poll instead.
+                    while True:
+                        try:
+                            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            break
+                        except BlockingIOError:
+                            time.sleep(0.01)
+                else:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def put(self, upload):
+        digest = upload.sha256
+        path = self.path_for(digest)
+        with self._locked(digest):
+            if os.path.exists(path):
+                with self.stats_lock:
+                    self.deduplicated += 1
+                    self.bytes_deduplicated += upload.size
+                return path
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            upload.link(path)
+
+        with self.stats_lock:
+            self.stored += 1
+            self.bytes_stored += upload.size
+        return path
+
+    def settle(self, upload):
+        """Make sure a committed upload's blob exists, then drop the staged copy."""
+        digest = upload.sha256
+        path = self.path_for(digest)
+        with self._locked(digest):
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                upload.link(path)
+        upload.close()
+
+    def _referenced(self, conn, digests):
+        cursor = conn.cursor()
+        try:
+            format_strings = ','.join(['%s'] * len(digests))
+            cursor.execute(f"""
+                SELECT DISTINCT content_hash FROM custom_homework_files
+                WHERE content_hash IN ({format_strings})
+            """, tuple(digests))
+            referenced = {row[0] for row in cursor.fetchall()}
+            # End the snapshot so the re-check below sees newer commits.
+            conn.commit()
+            return referenced
+        finally:
+            cursor.close()
+
+    def release(self, conn, digests):
+        digests = sorted(set(digests))
+        if not digests:
+            return
+
+        referenced = self._referenced(conn, digests)
+        moved = {}
+        for digest in digests:
+            if digest in referenced:
+                continue
+            path = self.path_for(digest)
+            released_path = f"{path}.{uuid.uuid4().hex}.released"
+            with self._locked(digest):
+                try:
+                    os.replace(path, released_path)
+                except FileNotFoundError:
+                    continue
+            moved[digest] = released_path
+
+        if not moved:
+            return
+
+        # A row committed after the first check gets the blob back here, or
+        # its request restores it from the staged copy in settle().
+        referenced = self._referenced(conn, list(moved))
+        removed = 0
+        for digest, released_path in moved.items():
+            if digest in referenced:
+                path = self.path_for(digest)
+                with self._locked(digest):
+                    if not os.path.exists(path):
+                        os.replace(released_path, path)
+                        continue
+            os.remove(released_path)
+            if digest not in referenced:
+                removed += 1
+
+        with self.stats_lock:
+            self.removed += removed
+
+    def snapshot(self):
+        with self.stats_lock:
+            return {
+                "stored": self.stored,
+                "deduplicated": self.deduplicated,
+                "removed": self.removed,
+                "bytes_stored": self.bytes_stored,
+                "bytes_deduplicated": self.bytes_deduplicated
+            }
+
+attachment_store = AttachmentStore(ATTACHMENT_STORE_FOLDER)
+
+def attachment_response(file_path, file_name, mime_type, content_hash):
+    """Send an attachment with validators, or hand it to the front proxy.
+
+    Content-addressed files use their SHA-256 as a strong ETag, so a
+    matching If-None-Match is answered without opening the file. When
+    FILE_OFFLOAD_MODE is set the response carries no body; the proxy
+    serves the bytes (including ranges) via X-Sendfile or an internal
+    X-Accel-Redirect location mapped onto UPLOAD_FOLDER.
+    """
+    if content_hash and request.if_none_match.contains(content_hash):
+        response = app.response_class(status=304)
+        response.set_etag(content_hash)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    offloaded = app.config['USE_X_SENDFILE']
+    response = send_file(
+        file_path,
+        mimetype=mime_type or 'application/octet-stream',
+        as_attachment=True,
+        download_name=file_name,
+        etag=content_hash or True,
+        conditional=not offloaded
+    )
+    response.cache_control.private = True
+
+    if offloaded and FILE_OFFLOAD_MODE == 'x-accel-redirect':
+        relative_path = os.path.relpath(response.headers.pop('X-Sendfile'), UPLOAD_FOLDER)
+        response.headers['X-Accel-Redirect'] = FILE_OFFLOAD_PREFIX.rstrip('/') + '/' + quote(relative_path)
+        response.headers.pop('Content-Length', None)
+
+    return response
+
+def collect_uploads(files, limit):
+    """Return (file_name, mime_type, upload) for up to limit usable uploads."""
+    attachments = []
+    for file in files:
+        if len(attachments) >= limit:
+            break
+        if not file or not file.filename:
+            continue
+        upload = file.stream
+        if not isinstance(upload, StreamedUpload) or not upload.usable:
+            continue
+        attachments.append((secure_filename(file.filename), file.content_type or 'application/octet-stream', upload))
+    return attachments
+
+def insert_homework_files(cursor, homework_id, attachments):
+    """Insert every attachment row of a homework entry in one statement."""
+    if not attachments:
+        return
+    rows = ','.join(['(%s, %s, %s, %s, %s, %s)'] * len(attachments))
+    params = []
+    for file_name, mime_type, upload in attachments:
+        params.extend([homework_id, file_name, upload.size, mime_type, attachment_store.path_for(upload.sha256), upload.sha256])
+    cursor.execute(f"""
+        INSERT INTO custom_homework_files (homework_id, file_name, file_size, mime_type, storage_path, content_hash)
+        VALUES {rows}
+    """, tuple(params))
+
+def remove_legacy_files(paths):
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+app.request_class = UploadRequest
+app.config['USE_X_SENDFILE'] = FILE_OFFLOAD_MODE in ('x-accel-redirect', 'x-sendfile')
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "5"))
+COMPRESS_ZSTD_LEVEL = int(os.getenv("COMPRESS_ZSTD_LEVEL", "3"))
+COMPRESS_CACHE_SIZE = int(os.getenv("COMPRESS_CACHE_SIZE", "256"))
+COMPRESS_CACHE_TTL = int(os.getenv("COMPRESS_CACHE_TTL", "300"))
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/')
+
+class ResponseCompressor:
+    """Accept-Encoding negotiation for buffered JSON and text responses.
+
+    File downloads are streamed (direct_passthrough) with byte ranges and
+    are never compressed, so zip/rar/jpg/png attachments go out untouched.
+    Responses that carry an ETag are deterministic for that tag, so their
+    compressed bodies are cached per (etag, encoding) and the tag is
+    weakened for the encoded representation.
+    """
+
+    def __init__(self, min_size, cache):
+        self.min_size = min_size
+        self.cache = cache
+        self.encoders = {}
+        if brotli is not None:
+            self.encoders['br'] = lambda data: brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+        if zstandard is not None:
+            self.encoders['zstd'] = lambda data: zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compress(data)
+        self.encoders['gzip'] = lambda data: gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+        self.lock = threading.Lock()
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def eligible(self, response):
+        if response.direct_passthrough or response.status_code < 200 or response.status_code in (204, 206, 304):
+            return False
+        if 'Content-Encoding' in response.headers:
+            return False
+        mimetype = response.mimetype or ''
+        return mimetype.startswith(COMPRESSIBLE_MIMETYPES)
+
+    def compress(self, response):
+        if not self.eligible(response):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if response.content_length is not None and response.content_length < self.min_size:
+            return response
+
+        encoding = request.accept_encodings.best_match(list(self.encoders))
+        if not encoding:
+            return response
+
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        etag, weak = response.get_etag()
+        cache_key = (etag, encoding) if etag else None
+        body = self.cache.get(cache_key) if cache_key else None
+        if body is None:
+            body = self.encoders[encoding](data)
+            if cache_key:
+                self.cache.put(cache_key, body)
+
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            response.set_etag(etag, weak=True)
+
+        with self.lock:
+            self.compressed += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(body)
+        return response
+
+    def snapshot(self):
+        with self.lock:
+            stats = {
+                "encodings": list(self.encoders),
+                "compressed": self.compressed,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out
+            }
+        stats["cache"] = self.cache.snapshot()
+        return stats
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILES_PER_HOMEWORK * MAX_FILE_SIZE + MAX_REQUEST_OVERHEAD
+app.config['MAX_FORM_MEMORY_SIZE'] = MAX_REQUEST_OVERHEAD
+
 DEVICES = [
   "Samsung SM-G998B", "Samsung SM-G991B", "Samsung SM-G996B", "Samsung SM-S901B", "Samsung SM-S906B", "Samsung SM-S908B", "Samsung SM-S911B", "Samsung SM-S916B", "Samsung SM-S918B", "Samsung SM-S921B", "Samsung SM-S926B", "Samsung SM-S928B",
   "Samsung SM-G980F", "Samsung SM-G985F", "Samsung SM-G988B", "Samsung SM-G981B", "Samsung SM-G986B", "Samsung SM-G780F", "Samsung SM-G781B", "Samsung SM-G990B",
@@ -336,35 +1182,355 @@ def get_random_device_model():
 def sha256_hash(text):
     return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
-def get_db_connection():
-    try:
-        return mysql.connector.connect(
+class PooledConnection:
+    def __init__(self, pool, conn, created_at, statements=None):
+        self._pool = pool
+        self._conn = conn
+        self.created_at = created_at
+        self.last_used = time.monotonic()
+        self.statements = statements if statements is not None else {}
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self)
+
+class DBPool:
+    def __init__(self, size, timeout, max_lifetime, ping_interval):
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+
+        self.idle = deque()
+        self.in_use = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+        self.stats = {
+            'acquired': 0,
+            'waited': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'peak_in_use': 0,
+            'created': 0,
+            'recycled': 0,
+            'health_check_failures': 0,
+        }
+
+    def _connect(self):
+        options = {}
+        if ASYNC_MODE == 'gevent':
+            # The C extension's socket I/O can't be monkey-patched. Only pass
+            # use_pure here: use_pure=False fails outright when the extension
+            # isn't installed instead of falling back to the pure driver.
+            options['use_pure'] = True
+        conn = mysql.connector.connect(
             host=DB_HOST,
             user=DB_USER,
             password=DB_PASSWORD,
-            database=DB_NAME
+            database=DB_NAME,
+            **options
         )
+        with self.cond:
+            self.stats['created'] += 1
+        return conn
+
+    def reset_after_fork(self):
+        """Forget connections inherited from the parent process.
+
+        Their sockets are shared with the parent, so they are dropped
+        without close() (which would send COM_QUIT on the parent's session).
+        """
+        self.idle = deque()
+        self.in_use = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, entry):
+        now = time.monotonic()
+        if now - entry.created_at > self.max_lifetime:
+            with self.cond:
+                self.stats['recycled'] += 1
+            return False
+        if now - entry.last_used > self.ping_interval:
+            try:
+                entry._conn.ping(reconnect=False)
+            except Exception:
+                with self.cond:
+                    self.stats['health_check_failures'] += 1
+                return False
+        return True
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        entry = None
+
+        with self.cond:
+            waited = False
+            while not self.idle and self.in_use >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise TimeoutError(f"DB pool exhausted ({self.size} connections in use)")
+                waited = True
+                self.waiting += 1
+                self.cond.wait(remaining)
+                self.waiting -= 1
+
+            if self.idle:
+                entry = self.idle.pop()
+            self.in_use += 1
+
+            wait_time = time.monotonic() - start
+            self.stats['acquired'] += 1
+            if waited:
+                self.stats['waited'] += 1
+            self.stats['wait_time_total'] += wait_time
+            self.stats['wait_time_max'] = max(self.stats['wait_time_max'], wait_time)
+            self.stats['peak_in_use'] = max(self.stats['peak_in_use'], self.in_use)
+
+        try:
+            if entry is not None and not self._is_healthy(entry):
+                self._discard(entry._conn)
+                entry = None
+            if entry is None:
+                entry = PooledConnection(self, self._connect(), time.monotonic())
+        except Exception:
+            with self.cond:
+                self.in_use -= 1
+                self.cond.notify()
+            raise
+
+        return entry
+
+    def release(self, entry):
+        conn = entry._conn
+        entry._conn = None
+
+        healthy = True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            healthy = False
+
+        if healthy:
+            reused = PooledConnection(self, conn, entry.created_at, entry.statements)
+        else:
+            self._discard(conn)
+
+        with self.cond:
+            self.in_use -= 1
+            if healthy:
+                self.idle.append(reused)
+            self.cond.notify()
+
+    def snapshot(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats.update({
+                'size': self.size,
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'waiting': self.waiting,
+                'saturation': round(self.in_use / self.size, 3) if self.size else 0,
+                'wait_time_avg': round(self.stats['wait_time_total'] / self.stats['acquired'], 6) if self.stats['acquired'] else 0,
+            })
+            return stats
+
+db_pool = DBPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_MAX_LIFETIME, DB_POOL_PING_INTERVAL)
+
+def get_db_connection():
+    try:
+        return db_pool.acquire()
     except Exception as e:
-        log(f"DB Connection failed: {e}")
+        log(f"DB Connection failed: {e}", logging.ERROR)
         return None
 
+def get_request_db():
+    if 'db_conn' not in g:
+        g.db_conn = get_db_connection()
+    return g.db_conn
+
+@app.teardown_appcontext
+def release_request_db(exception=None):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.close()
+
+class PreparedStatements:
+    """Named server-side prepared statements for the hot queries.
+
+    Each pooled connection keeps one prepared cursor per statement name, so
+    MySQL parses a statement once per connection instead of once per call.
+    The first execution on a connection includes the prepare round trip;
+    comparing its time with later executions gives the parse cost.
+
+    mysql.connector only reuses a prepared statement when it is executed
+    with the very same string object, so the first SQL seen for a name is
+    kept and passed on every later call; callers may rebuild the text.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sql = {}
+        self.stats = {}
+
+    def _record(self, name, prepared, elapsed):
+        with self.lock:
+            entry = self.stats.get(name)
+            if entry is None:
+                entry = self.stats[name] = {
+                    'prepares': 0,
+                    'prepare_time_total': 0.0,
+                    'executions': 0,
+                    'execute_time_total': 0.0,
+                }
+            if prepared:
+                entry['prepares'] += 1
+                entry['prepare_time_total'] += elapsed
+            else:
+                entry['executions'] += 1
+                entry['execute_time_total'] += elapsed
+
+    def execute(self, conn, name, sql, params=()):
+        sql = self.sql.setdefault(name, sql)
+        cursor = conn.statements.get(name)
+        prepared = cursor is None
+        start = time.perf_counter()
+        try:
+            if prepared:
+                cursor = conn.cursor(prepared=True)
+                conn.statements[name] = cursor
+            cursor.execute(sql, tuple(params))
+            rows = cursor.fetchall()
+        except Exception:
+            conn.statements.pop(name, None)
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+            raise
+        self._record(name, prepared, time.perf_counter() - start)
+        return rows
+
+    def snapshot(self):
+        with self.lock:
+            statements = {}
+            for name, entry in sorted(self.stats.items()):
+                prepare_avg = entry['prepare_time_total'] / entry['prepares'] if entry['prepares'] else 0
+                execute_avg = entry['execute_time_total'] / entry['executions'] if entry['executions'] else 0
+                statements[name] = {
+                    'prepares': entry['prepares'],
+                    'executions': entry['executions'],
+                    'prepare_ms_avg': round(prepare_avg * 1000, 3),
+                    'execute_ms_avg': round(execute_avg * 1000, 3),
+                    'parse_ms_avg': round(max(prepare_avg - execute_avg, 0) * 1000, 3) if entry['prepares'] and entry['executions'] else None,
+                }
+            return statements
+
+prepared_statements = PreparedStatements()
+
+class TTLCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at <= now:
+                del self.entries[key]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.stats['invalidations'] += len(self.entries)
+            self.entries.clear()
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            lookups = stats['hits'] + stats['misses']
+            stats.update({
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hit_ratio': round(stats['hits'] / lookups, 3) if lookups else 0,
+            })
+            return stats
+
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+response_compressor = ResponseCompressor(COMPRESS_MIN_SIZE, TTLCache(COMPRESS_CACHE_SIZE, COMPRESS_CACHE_TTL))
+
 def save_session(cookies):
     conn = get_db_connection()
     if not conn:
-        log("Cannot save session: DB not available")
+        log("Cannot save session: DB not available", logging.WARNING)
         return
 
     try:
         cursor = conn.cursor()
         cookie_data = json.dumps(requests.utils.dict_from_cookiejar(cookies))
 
-        cursor.execute(, (cookie_data, cookie_data))
+        cursor.execute("""
+            INSERT INTO server_sessions (id, cookies) VALUES (1, %s)
+            ON DUPLICATE KEY UPDATE cookies = %s
+        """, (cookie_data, cookie_data))
         conn.commit()
         cursor.close()
-        conn.close()
         log("Session saved to DB.")
     except Exception as e:
-        log(f"Error saving session to DB: {e}")
+        log(f"Error saving session to DB: {e}", logging.ERROR)
+    finally:
+        conn.close()
 
 def load_session():
     conn = get_db_connection()
@@ -376,50 +1542,130 @@ def load_session():
         cursor.execute("SELECT cookies FROM server_sessions WHERE id = 1")
         row = cursor.fetchone()
         cursor.close()
-        conn.close()
 
         if row:
             cookie_dict = json.loads(row[0])
             return requests.utils.cookiejar_from_dict(cookie_dict)
     except Exception as e:
-        log(f"Error loading session from DB: {e}")
+        log(f"Error loading session from DB: {e}", logging.ERROR)
+    finally:
+        conn.close()
 
     return None
 
 def log_request(method, url, headers, body=None):
-    log("\n========== API REQUEST ==========")
-    log(f"URL: {url}")
-    log(f"Method: {method}")
-    log("Headers:")
-    if headers:
-        for key, value in headers.items():
-            if key.lower() == "cookie":
-                log(f"  {key}: [COOKIES HIDDEN]")
-            else:
-                log(f"  {key}: {value}")
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
 
-    if body:
-        log(f"Body: {body}")
-    else:
-        log("Body: [empty]")
-    log("==================================\n")
+    log(f"Upstream request: {method} {url}", logging.DEBUG)
+    if headers:
+        log(f"Upstream request headers: {format_headers(headers)}", logging.DEBUG)
+    if body and LOG_REQUEST_BODIES:
+        text = body if isinstance(body, str) else json.dumps(body)
+        log(f"Upstream request body: {format_body(text)}", logging.DEBUG)
 
 def log_response(response):
-    log("\n========== API RESPONSE ==========")
-    log(f"URL: {response.url}")
-    log(f"Status Code: {response.status_code}")
-    log("Headers:")
-    for key, value in response.headers.items():
-        log(f"  {key}: {value}")
-
-    if response.text:
-        if len(response.text) > 2000:
-            log(f"Response Body: {response.text[:2000]}... [Truncated]")
-        else:
-            log(f"Response Body: {response.text}")
-    else:
-        log("Response Body: [empty]")
-    log("==================================\n")
+    elapsed_ms = response.elapsed.total_seconds() * 1000
+    log(f"Upstream {response.request.method} {response.url} {response.status_code} {elapsed_ms:.1f}ms")
+
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    log(f"Upstream response headers: {format_headers(response.headers)}", logging.DEBUG)
+    if LOG_RESPONSE_BODIES and response.text:
+        log(f"Upstream response body: {format_body(response.text)}", logging.DEBUG)
+
+class UpstreamClient:
+    def __init__(self, base_url, pool_size, timeout):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        self.session = self._new_session()
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            "Accept": "application/json, text/plain, */*",
+            "User-Agent": USER_AGENT,
+            "Origin": "https://app.eschool.center",
+            "Referer": "https://app.eschool.center/"
+        })
+        return session
+
+    def reset_after_fork(self):
+        """Replace pooled sockets shared with the parent, keeping the cookies."""
+        cookies = self.session.cookies
+        self.session = self._new_session()
+        self.session.cookies = cookies
+        self.lock = threading.Lock()
+
+    def set_cookies(self, cookies):
+        jar = requests.cookies.RequestsCookieJar()
+        if cookies:
+            jar.update(cookies)
+        self.session.cookies = jar
+
+    def _endpoint_stats(self, path):
+        endpoint = path.split('?', 1)[0]
+        return self.stats.setdefault(endpoint, {
+            'calls': 0,
+            'errors': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+            'bytes_total': 0,
+            'parse_time_total': 0.0,
+        })
+
+    def _record(self, path, elapsed, error=False, size=0):
+        with self.lock:
+            stats = self._endpoint_stats(path)
+            stats['calls'] += 1
+            if error:
+                stats['errors'] += 1
+            stats['latency_total'] += elapsed
+            stats['latency_max'] = max(stats['latency_max'], elapsed)
+            stats['bytes_total'] += size
+
+    def parse_json(self, response, path):
+        start = time.monotonic()
+        data = response.json()
+        with self.lock:
+            self._endpoint_stats(path)['parse_time_total'] += time.monotonic() - start
+        return data
+
+    def request(self, method, path, headers=None, data=None):
+        url = f"{self.base_url}{path}"
+        log_request(method, url, headers, data)
+
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, url, headers=headers, data=data, timeout=self.timeout)
+        except Exception:
+            self._record(path, time.monotonic() - start, error=True)
+            raise
+        self._record(path, time.monotonic() - start, error=response.status_code >= 400, size=len(response.content))
+
+        log_response(response)
+        return response
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                endpoint: {
+                    **stats,
+                    'latency_avg': round(stats['latency_total'] / stats['calls'], 6) if stats['calls'] else 0,
+                }
+                for endpoint, stats in self.stats.items()
+            }
+
+upstream = UpstreamClient(BASE_URL, UPSTREAM_POOL_SIZE, UPSTREAM_TIMEOUT)
+upstream_executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix="upstream")
 
 def login(username, password):
     if not username or not password:
@@ -448,41 +1694,26 @@ def login(username, password):
     }
 
     headers = {
-        "Accept": "application/json, text/plain, */*",
-        "User-Agent": USER_AGENT,
         "Accept-Language": "ru-RU,en,*",
-        "Origin": "https://app.eschool.center",
-        "Referer": "https://app.eschool.center/",
         "Content-Type": "application/x-www-form-urlencoded"
     }
 
     try:
-        url = f"{BASE_URL}/login"
-        log_request("POST", url, headers, body)
-        response = requests.post(url, data=body, headers=headers)
-        log_response(response)
+        response = upstream.request("POST", "/login", headers, body)
 
         if response.status_code == 200:
             if 'JSESSIONID' in response.cookies or len(response.text) > 5:
+                upstream.set_cookies(response.cookies)
                 save_session(response.cookies)
                 return response.cookies
         return None
     except Exception as e:
-        log(f"Login error: {e}")
+        log(f"Login error: {e}", logging.ERROR)
         return None
 
-def get_state(cookies):
-    headers = {
-        "Accept": "application/json, text/plain, */*",
-        "User-Agent": USER_AGENT,
-        "Origin": "https://app.eschool.center",
-        "Referer": "https://app.eschool.center/"
-    }
+def get_state():
     try:
-        url = f"{BASE_URL}/state"
-        log_request("GET", url, headers)
-        response = requests.get(url, headers=headers, cookies=cookies)
-        log_response(response)
+        response = upstream.request("GET", "/state")
 
         if response.status_code == 200:
             return response.json()
@@ -490,36 +1721,188 @@ def get_state(cookies):
     except Exception:
         return None
 
-def get_messages(cookies):
-    global CURRENT_COOKIES
-    headers = {
-        "Accept": "application/json, text/plain, */*",
-        "User-Agent": USER_AGENT,
-        "Origin": "https://app.eschool.center",
-        "Referer": "https://app.eschool.center/"
-    }
+class SessionManager:
+    def __init__(self, keepalive_interval):
+        self.keepalive_interval = keepalive_interval
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.bootstrap_thread = None
+
+        self.stats = {
+            'logins': 0,
+            'login_failures': 0,
+            'coalesced_refreshes': 0,
+            'shared_refreshes': 0,
+            'keepalives': 0,
+            'keepalive_failures': 0,
+        }
+
+    def adopt(self, cookies, state=None):
+        global CURRENT_COOKIES, MY_PRS_ID
+        upstream.set_cookies(cookies)
+        CURRENT_COOKIES = cookies
+        if state:
+            MY_PRS_ID = state.get('user', {}).get('prsId')
+        self.generation += 1
+
+    def refresh(self, seen_generation):
+        """Replace an expired session, logging in at most once across workers.
+
+        Threads of this worker coalesce on self.lock; workers serialise on
+        the eschool_login named lock and reload the stored session inside
+        it, so a worker that finds a newer session saved by another one
+        adopts it instead of logging in again.
+        """
+        with self.lock:
+            if self.generation != seen_generation:
+                self.stats['coalesced_refreshes'] += 1
+                return True
+
+            conn = get_db_connection()
+            if not conn:
+                return self._login()
+            try:
+                with db_advisory_lock(conn, f"{DB_NAME}.eschool_login", LOGIN_LOCK_TIMEOUT) as acquired:
+                    if not acquired:
+                        log("Another worker is still logging in to eSchool.", logging.WARNING)
+                        return False
+
+                    cookies = load_session()
+                    current = requests.utils.dict_from_cookiejar(CURRENT_COOKIES) if CURRENT_COOKIES else None
+                    if cookies and requests.utils.dict_from_cookiejar(cookies) != current:
+                        self.stats['shared_refreshes'] += 1
+                        self.adopt(cookies)
+                        log("Adopted the session saved by another worker.")
+                        return True
+
+                    return self._login()
+            finally:
+                conn.close()
+
+    def _login(self):
+        log("Session expired, attempting re-login...", logging.WARNING)
+        cookies = login(os.getenv("ESCHOOL_USERNAME"), os.getenv("ESCHOOL_PASSWORD"))
+        if not cookies:
+            self.stats['login_failures'] += 1
+            log("Re-login failed.", logging.WARNING)
+            return False
+
+        self.stats['logins'] += 1
+        self.adopt(cookies)
+        log("Re-login successful.")
+        return True
+
+    def start_bootstrap(self):
+        if self.bootstrap_thread and self.bootstrap_thread.is_alive():
+            return
+        self.bootstrap_thread = threading.Thread(target=self.bootstrap, name="session-bootstrap", daemon=True)
+        self.bootstrap_thread.start()
+
+    def bootstrap(self):
+        """Validate the stored session, logging in if needed, then start the pollers.
+
+        Runs in the background so a fresh worker serves DB-only endpoints
+        right away, and retries with backoff until it is authenticated, so a
+        short eSchool or MySQL outage at boot does not leave the worker
+        without a session until restart.
+        """
+        delay = LOGIN_RETRY_MIN_DELAY
+        while True:
+            state = self._authenticate()
+            if state:
+                break
+            log(f"Server not authenticated, retrying in {delay:g}s (check the eSchool credentials in .env)", logging.ERROR)
+            time.sleep(delay)
+            delay = min(delay * 2, LOGIN_RETRY_MAX_DELAY)
+
+        self.adopt(CURRENT_COOKIES, state)
+        name = state.get('profile', {}).get('firstName')
+        log(f"Server authenticated as {name} (PRS ID: {MY_PRS_ID})")
+        poller_election.start()
+
+    def _authenticate(self):
+        """One attempt; returns the eSchool state or None.
+
+        Workers serialise on a MySQL named lock and reload the stored session
+        inside it, so only the first to find it expired logs in and the
+        others pick up the cookies it saved. A worker that can't get the
+        lock in time doesn't log in on its own; it tries again later.
+        """
+        state = None
+        conn = get_db_connection()
+        if not conn:
+            return None
+        try:
+            with db_advisory_lock(conn, f"{DB_NAME}.eschool_login", LOGIN_LOCK_TIMEOUT) as acquired:
+                if not acquired:
+                    log("Another worker is still logging in to eSchool.", logging.WARNING)
+                    return None
+
+                cookies = load_session()
+                if cookies:
+                    self.adopt(cookies)
+
+                state = get_state() if CURRENT_COOKIES else None
+                if not state:
+                    if CURRENT_COOKIES:
+                        log("Session expired.", logging.WARNING)
+                    # The login lock is already held here, so log in directly
+                    # rather than through refresh().
+                    with self.lock:
+                        logged_in = self._login()
+                    if logged_in:
+                        state = get_state()
+        except Exception as e:
+            log(f"Error authenticating server: {e}", logging.ERROR)
+        finally:
+            conn.close()
+        return state
+
+    def start_keepalive(self):
+        if self.keepalive_interval <= 0 or (self.thread and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="session-keepalive", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        while not self.stop_event.wait(self.keepalive_interval):
+            generation = self.generation
+            if get_state() is not None:
+                self.stats['keepalives'] += 1
+                continue
+
+            self.stats['keepalive_failures'] += 1
+            self.refresh(generation)
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            'generation': self.generation,
+            'authenticated': CURRENT_COOKIES is not None,
+            'keepalive_running': bool(self.thread and self.thread.is_alive()),
+        }
+
+session_manager = SessionManager(SESSION_KEEPALIVE_INTERVAL)
+
+def get_messages(row=0, rows_count=50):
     try:
-        url = f"{BASE_URL}/chat/threads?newOnly=false&row=0&rowsCount=50"
-        log_request("GET", url, headers)
-        response = requests.get(url, headers=headers, cookies=cookies)
-        log_response(response)
+        path = f"/chat/threads?newOnly=false&row={row}&rowsCount={rows_count}"
+        generation = session_manager.generation
+        response = upstream.request("GET", path)
 
         if response.status_code == 401:
-            log("Received 401, attempting re-login...")
-            username = os.getenv("ESCHOOL_USERNAME")
-            password = os.getenv("ESCHOOL_PASSWORD")
-            new_cookies = login(username, password)
-            if new_cookies:
-                CURRENT_COOKIES = new_cookies
-                log("Re-login successful, retrying request...")
-                response = requests.get(url, headers=headers, cookies=new_cookies)
-                log_response(response)
-            else:
-                log("Re-login failed.")
+            if not session_manager.refresh(generation):
                 return []
+            response = upstream.request("GET", path)
 
         if response.status_code == 200:
-            threads = response.json()
+            threads = upstream.parse_json(response, path)
             messages = []
             for thread in threads:
                 messages.append({
@@ -532,48 +1915,505 @@ def get_messages(cookies):
             return messages
         return []
     except Exception as e:
-        log(f"Error fetching messages: {e}")
+        log(f"Error fetching messages: {e}", logging.ERROR)
         return []
 
-def get_thread_messages(cookies, thread_id):
-    global CURRENT_COOKIES
+def get_thread_messages(thread_id, msg_nums=None, row_start=0, rows_count=50):
     headers = {
-        "Accept": "application/json, text/plain, */*",
-        "User-Agent": USER_AGENT,
-        "Origin": "https://app.eschool.center",
-        "Referer": "https://app.eschool.center/",
         "Content-Type": "application/json"
     }
     try:
-        url = f"{BASE_URL}/chat/messages?getNew=false&isSearch=false&rowStart=0&rowsCount=50&threadId={thread_id}"
-        body = json.dumps({"msgNums": None, "searchText": None})
+        get_new = 'true' if msg_nums else 'false'
+        path = f"/chat/messages?getNew={get_new}&isSearch=false&rowStart={row_start}&rowsCount={rows_count}&threadId={thread_id}"
+        body = json.dumps({"msgNums": msg_nums, "searchText": None})
 
-        log_request("PUT", url, headers, body)
-        response = requests.put(url, headers=headers, cookies=cookies, data=body)
-        log_response(response)
+        generation = session_manager.generation
+        response = upstream.request("PUT", path, headers, body)
 
         if response.status_code == 401:
-            log("Received 401, attempting re-login...")
-            username = os.getenv("ESCHOOL_USERNAME")
-            password = os.getenv("ESCHOOL_PASSWORD")
-            new_cookies = login(username, password)
-            if new_cookies:
-                CURRENT_COOKIES = new_cookies
-                log("Re-login successful, retrying request...")
-                response = requests.put(url, headers=headers, cookies=new_cookies, data=body)
-                log_response(response)
-            else:
-                log("Re-login failed.")
+            if not session_manager.refresh(generation):
                 return []
+            response = upstream.request("PUT", path, headers, body)
 
         if response.status_code == 200:
-            return response.json()
+            return upstream.parse_json(response, path)
         return []
     except Exception as e:
-        log(f"Error fetching thread messages: {e}")
+        log(f"Error fetching thread messages: {e}", logging.ERROR)
         return []
 
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {'calls': 0, 'shared': 0}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self.calls[key] = call
+                self.stats['calls'] += 1
+                leader = True
+            else:
+                self.stats['shared'] += 1
+                leader = False
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['event'].set()
+
+    def snapshot(self):
+        with self.lock:
+            return {**self.stats, 'in_flight': len(self.calls)}
+
+upstream_cache = TTLCache(UPSTREAM_CACHE_SIZE, UPSTREAM_CACHE_TTL)
+upstream_flight = SingleFlight()
+
+def coalesced_upstream_call(key, fn, *args):
+    result = upstream_cache.get(key)
+    if result is not None:
+        return result
+
+    def load():
+        result = fn(*args)
+        upstream_cache.put(key, result)
+        return result
+
+    return upstream_flight.do(key, load)
+
+def extract_verification_codes(text):
+    codes = set()
+    for run in VERIFICATION_CODE_RE.findall(text or ''):
+        for i in range(len(run) - VERIFICATION_CODE_LENGTH + 1):
+            codes.add(run[i:i + VERIFICATION_CODE_LENGTH])
+    return codes
+
+class InboxIndexer:
+    def __init__(self, interval, max_threads, page_size, max_rows, code_ttl, index_size):
+        self.interval = interval
+        self.max_threads = max_threads
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.codes = TTLCache(index_size, code_ttl)
+
+        self.lock = threading.Lock()
+        self.thread_dates = {}
+        self.cursors = {}
+        self.threads_watermark = None
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.stats = {
+            'polls': 0,
+            'errors': 0,
+            'thread_pages': 0,
+            'message_pages': 0,
+            'threads_synced': 0,
+            'messages_fetched': 0,
+            'codes_indexed': 0,
+            'last_poll_at': None,
+            'last_poll_duration': 0.0,
+        }
+
+    def start(self):
+        if self.interval <= 0 or (self.thread and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="inbox-indexer", daemon=True)
+        self.thread.start()
+        log(f"Inbox indexer started (every {self.interval}s)")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                self.stats['errors'] += 1
+                log(f"Inbox indexer error: {e}", logging.ERROR)
+            self.stop_event.wait(self.interval)
+
+    def _index(self, text, prs_id):
+        if not prs_id:
+            return
+        for code in extract_verification_codes(text):
+            self.codes.put(code, prs_id)
+            self.stats['codes_indexed'] += 1
+
+    def sync_threads(self):
+        with self.lock:
+            watermark = self.threads_watermark
+
+        threads = []
+        while len(threads) < self.max_rows:
+            rows_count = min(self.page_size, self.max_rows - len(threads))
+            page = get_messages(len(threads), rows_count)
+            self.stats['thread_pages'] += 1
+            threads.extend(page)
+
+            if len(page) < rows_count:
+                break
+            if watermark is not None and any((thread.get('date') or 0) <= watermark for thread in page):
+                break
+
+        for thread in threads:
+            self._index(thread.get('preview'), thread.get('imgObjId'))
+
+        if threads:
+            newest = max(thread.get('date') or 0 for thread in threads)
+            with self.lock:
+                self.threads_watermark = max(self.threads_watermark or 0, newest)
+        return threads
+
+    def changed_threads(self, threads, limit):
+        with self.lock:
+            changed = [
+                thread for thread in threads
+                if thread.get('threadId') and self.thread_dates.get(thread.get('threadId')) != thread.get('date')
+            ]
+        return changed[:limit]
+
+    def sync_thread(self, thread_id, date=None):
+        key = str(thread_id)
+        with self.lock:
+            last_num = self.cursors.get(key)
+
+        messages = []
+        if last_num is None:
+            messages = get_thread_messages(thread_id, rows_count=self.max_rows)
+            self.stats['message_pages'] += 1
+        else:
+            row_start = 0
+            while row_start < self.max_rows:
+                rows_count = min(self.page_size, self.max_rows - row_start)
+                page = get_thread_messages(thread_id, [last_num], row_start, rows_count)
+                self.stats['message_pages'] += 1
+                row_start += len(page)
+                new = [msg for msg in page if (msg.get('msgNum') or 0) > last_num]
+                messages.extend(new)
+                # getNew isn't trusted to filter: a message at or below the
+                # cursor means everything newer has already been read.
+                if len(new) < len(page) or len(page) < rows_count:
+                    break
+
+        for msg in messages:
+            self._index(msg.get('msg'), msg.get('senderId'))
+
+        newest = max((msg.get('msgNum') or 0 for msg in messages), default=None)
+        with self.lock:
+            if newest is not None:
+                self.cursors[key] = max(self.cursors.get(key) or 0, newest)
+            if date is not None:
+                self.thread_dates[thread_id] = date
+
+        self.stats['threads_synced'] += 1
+        self.stats['messages_fetched'] += len(messages)
+        return messages
+
+    def poll_once(self):
+        start = time.monotonic()
+        threads = self.sync_threads()
+        for thread in self.changed_threads(threads, self.max_threads):
+            self.sync_thread(thread.get('threadId'), thread.get('date'))
+
+        self.stats['polls'] += 1
+        self.stats['last_poll_at'] = time.time()
+        self.stats['last_poll_duration'] = round(time.monotonic() - start, 3)
+
+    def lookup(self, code):
+        return self.codes.get(code)
+
+    def snapshot(self):
+        with self.lock:
+            tracked = len(self.cursors)
+        return {
+            **self.stats,
+            'running': bool(self.thread and self.thread.is_alive()),
+            'tracked_threads': tracked,
+            'index': self.codes.snapshot(),
+        }
+
+inbox_indexer = InboxIndexer(
+    INBOX_POLL_INTERVAL,
+    INBOX_POLL_THREADS,
+    CHAT_PAGE_SIZE,
+    CHAT_MAX_ROWS,
+    VERIFICATION_CODE_TTL,
+    VERIFICATION_INDEX_SIZE
+)
+
+class PollerElection:
+    """Elect one worker, across processes and hosts, to poll eSchool.
+
+    Only the leader runs the inbox indexer and the session keepalive, so
+    upstream load follows the poll interval rather than the worker count;
+    other workers fall back to on-demand thread syncs. Leadership is a MySQL
+    named lock held on a dedicated connection, released by the server when
+    that connection drops, so a dead leader is replaced within one interval.
+    """
+
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        self.conn = None
+        self.leader = False
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.stats = {
+            'elections': 0,
+            'leadership_lost': 0,
+        }
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="poller-election", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def reset_after_fork(self):
+        """Forget the parent's connection without closing it (see DBPool)."""
+        self.conn = None
+        self.leader = False
+        self.thread = None
+
+    def _check(self):
+        try:
+            if self.conn is None:
+                self.conn = db_pool._connect()
+            elif self.leader:
+                self.conn.ping(reconnect=False)
+                return True
+
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT GET_LOCK(%s, 0)", (self.name,))
+            self.leader = cursor.fetchone()[0] == 1
+            cursor.close()
+            if self.leader:
+                self.stats['elections'] += 1
+                log("This worker now runs the inbox indexer and session keepalive")
+            return self.leader
+        except Exception as e:
+            if self.leader:
+                self.stats['leadership_lost'] += 1
+                log(f"Lost the poller lock: {e}", logging.WARNING)
+            self.leader = False
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except Exception:
+                    pass
+                self.conn = None
+            return False
+
+    def _run(self):
+        while True:
+            if self._check():
+                session_manager.start_keepalive()
+                inbox_indexer.start()
+            else:
+                session_manager.stop()
+                inbox_indexer.stop()
+            if self.stop_event.wait(self.interval):
+                break
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            'leader': self.leader,
+        }
+
+poller_election = PollerElection(f"{DB_NAME}.eschool_poller", POLLER_ELECTION_INTERVAL)
+
+def sync_threads_shared():
+    return coalesced_upstream_call(('threads',), inbox_indexer.sync_threads)
+
+def sync_thread_shared(thread_id, date=None):
+    return coalesced_upstream_call(('thread', str(thread_id)), inbox_indexer.sync_thread, thread_id, date)
+
+def column_exists(cursor, table, column):
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    """, (DB_NAME, table, column))
+    return cursor.fetchone()[0] > 0
+
+def index_exists(cursor, table, index):
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND INDEX_NAME = %s
+    """, (DB_NAME, table, index))
+    return cursor.fetchone()[0] > 0
+
+def add_index(table, index, columns):
+    """Migration step: build a secondary index online if it is missing."""
+    def step(cursor):
+        if not index_exists(cursor, table, index):
+            cursor.execute(f"ALTER TABLE {table} ADD INDEX {index} ({columns}), ALGORITHM=INPLACE, LOCK=NONE")
+    return step
+
+def add_column(table, column, definition):
+    """Migration step: add a nullable column online if it is missing."""
+    def step(cursor):
+        if not column_exists(cursor, table, column):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}, ALGORITHM=INPLACE, LOCK=NONE")
+    return step
+
+def preserve_legacy_verified_users(cursor):
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'verified_users'
+        AND COLUMN_NAME = 'prs_id' AND COLUMN_KEY = 'PRI'
+    """, (DB_NAME,))
+    if cursor.fetchone()[0] > 0:
+        log("Moving single-device verified_users aside as verified_users_legacy...")
+        cursor.execute("RENAME TABLE verified_users TO verified_users_legacy")
+
+# Append-only: each entry is (version, description, steps). Steps are SQL
+# strings or callables taking a cursor, and must be safe to re-run, since
+# MySQL DDL commits implicitly and a crash can leave a version half applied.
+MIGRATIONS = [
+    (1, "base schema", [
+        preserve_legacy_verified_users,
+        """
+            CREATE TABLE IF NOT EXISTS server_sessions (
+                id INT PRIMARY KEY,
+                cookies TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS verified_users (
+                token VARCHAR(36) PRIMARY KEY,
+                prs_id BIGINT NOT NULL,
+                device_name VARCHAR(255),
+                full_name VARCHAR(255),
+                grade_class VARCHAR(50),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS custom_homework (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                author_prs_id BIGINT NOT NULL,
+                author_full_name VARCHAR(255),
+                grade_class VARCHAR(50) NOT NULL,
+                subject VARCHAR(255) NOT NULL,
+                lesson_date DATE NOT NULL,
+                text TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS custom_homework_files (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                homework_id INT NOT NULL,
+                file_name VARCHAR(255) NOT NULL,
+                file_size BIGINT NOT NULL,
+                mime_type VARCHAR(100),
+                storage_path VARCHAR(512) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (homework_id) REFERENCES custom_homework(id) ON DELETE CASCADE
+            )
+        """,
+    ]),
+    (2, "content-addressed attachments", [
+        add_column('custom_homework_files', 'content_hash', 'CHAR(64) AFTER storage_path'),
+        add_index('custom_homework_files', 'idx_custom_homework_files_content_hash', 'content_hash'),
+    ]),
+    (3, "homework delta sync", [
+        """
+            CREATE TABLE IF NOT EXISTS custom_homework_versions (
+                grade_class VARCHAR(50) PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS custom_homework_tombstones (
+                homework_id INT PRIMARY KEY,
+                grade_class VARCHAR(50) NOT NULL,
+                deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                INDEX idx_custom_homework_tombstones_class (grade_class, deleted_at)
+            )
+        """,
+        add_index('custom_homework', 'idx_custom_homework_class_updated', 'grade_class, updated_at'),
+    ]),
+    (4, "shared rate limit counters", [
+        """
+            CREATE TABLE IF NOT EXISTS rate_limit_counters (
+                limit_key VARCHAR(191) NOT NULL,
+                window_start BIGINT NOT NULL,
+                count INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (limit_key, window_start),
+                INDEX idx_rate_limit_counters_window (window_start)
+            )
+        """,
+    ]),
+    (5, "secondary indexes for hot lookups", [
+        add_index('verified_users', 'idx_verified_users_prs_created', 'prs_id, created_at'),
+        add_index('custom_homework', 'idx_custom_homework_class_lesson', 'grade_class, lesson_date, created_at'),
+        # Supersedes the index MySQL created implicitly for the foreign key.
+        add_index('custom_homework_files', 'idx_custom_homework_files_homework', 'homework_id'),
+    ]),
+    (6, "token revocation version", [
+        """
+            CREATE TABLE IF NOT EXISTS token_revocations (
+                id INT PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0
+            )
+        """,
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+MIGRATION_LOCK_TIMEOUT = int(os.getenv("MIGRATION_LOCK_TIMEOUT", "60"))
+
+def get_schema_version(cursor):
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+        return cursor.fetchone()[0] or 0
+    except mysql.connector.Error:
+        return 0
+
+@contextmanager
+def db_advisory_lock(conn, name, timeout):
+    """Hold a MySQL named lock (GET_LOCK), shared by every worker and host."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+    acquired = cursor.fetchone()[0] == 1
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+            cursor.fetchone()
+        cursor.close()
+
 def init_db():
+    """Bring the schema up to date; an up-to-date database costs one query."""
     conn = get_db_connection()
     if not conn:
         log("Skipping DB initialization (no connection)")
@@ -581,57 +2421,121 @@ def init_db():
 
     try:
         cursor = conn.cursor()
+        if get_schema_version(cursor) >= SCHEMA_VERSION:
+            cursor.close()
+            return
+
+        with db_advisory_lock(conn, f"{DB_NAME}.schema_migrations", MIGRATION_LOCK_TIMEOUT) as acquired:
+            if not acquired:
+                raise TimeoutError("timed out waiting for another process to finish migrating")
+
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            current = get_schema_version(cursor)
+
+            for version, description, steps in MIGRATIONS:
+                if version <= current:
+                    continue
 
-        cursor.execute(, (DB_NAME,))
-        old_schema = cursor.fetchone()[0] > 0
-
-        if old_schema:
-            log("Migrating verified_users table to new schema (multi-device support)...")
-            cursor.execute("DROP TABLE IF EXISTS verified_users")
-            log("Old table dropped, creating new schema...")
+                log(f"Applying migration {version}: {description}...")
+                started = time.monotonic()
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                    (version, description)
+                )
+                conn.commit()
+                log(f"Migration {version} applied in {(time.monotonic() - started) * 1000:.0f}ms")
 
-        cursor.execute()
-        cursor.execute()
-        cursor.execute()
-        cursor.execute()
-        conn.commit()
-        log("Database initialized.")
+        log(f"Database schema at version {SCHEMA_VERSION}.")
         cursor.close()
-        conn.close()
     except Exception as e:
-        log(f"Error initializing DB: {e}")
+        log(f"Error initializing DB: {e}", logging.ERROR)
+    finally:
+        conn.close()
+
+server_initialized = False
+worker_pid = None
+worker_lock = threading.Lock()
 
 def initialize_server():
-    global CURRENT_COOKIES, MY_PRS_ID
+    """Load state shared by all workers: the schema and the stored session.
+
+    Runs once per process; with a preloading server (gunicorn --preload)
+    that is once in the master, and forked workers inherit CURRENT_COOKIES.
+    Nothing here talks to eSchool: the session is validated (and renewed)
+    in the background by start_worker().
+    """
+    global server_initialized
+    if server_initialized:
+        return
+    server_initialized = True
 
     log("Initializing server...")
 
     init_db()
 
     cookies = load_session()
-
-    state = None
     if cookies:
-        state = get_state(cookies)
-        if not state:
-            log("Session expired.")
-            cookies = None
-
-    if not cookies:
-        username = os.getenv("ESCHOOL_USERNAME")
-        password = os.getenv("ESCHOOL_PASSWORD")
-        if username and password:
-            cookies = login(username, password)
-            if cookies:
-                state = get_state(cookies)
-
-    if state and cookies:
-        CURRENT_COOKIES = cookies
-        MY_PRS_ID = state.get('user', {}).get('prsId')
-        name = state.get('profile', {}).get('firstName')
-        log(f"Server authenticated as {name} (PRS ID: {MY_PRS_ID})")
-    else:
-        log("Failed to authenticate server. Please check .env")
+        session_manager.adopt(cookies)
+
+def start_worker():
+    """Start this process's background threads, once per worker."""
+    global worker_pid
+    with worker_lock:
+        if worker_pid == os.getpid():
+            return
+        worker_pid = os.getpid()
+
+    if log_listener_pid != os.getpid():
+        start_log_listener()
+
+    if isinstance(rate_limiter, SharedRateLimiter):
+        rate_limiter.start()
+
+    session_manager.start_bootstrap()
+
+def reinitialize_after_fork():
+    """Drop state a forked worker must not share with its parent.
+
+    Only resets here; threads are started later by start_worker(), once the
+    worker's own runtime (e.g. gevent's hub) is ready.
+    """
+    global worker_lock
+    worker_lock = threading.Lock()
+    atexit.unregister(log_listener.stop)
+    log_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    db_pool.reset_after_fork()
+    upstream.reset_after_fork()
+    attachment_store.prefix_locks = {}
+    session_manager.thread = None
+    session_manager.bootstrap_thread = None
+    inbox_indexer.thread = None
+    poller_election.reset_after_fork()
+    if isinstance(rate_limiter, SharedRateLimiter):
+        rate_limiter.thread = None
+        rate_limiter.pending_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=reinitialize_after_fork)
+
+def create_app():
+    """WSGI application factory (see wsgi.py and gunicorn.conf.py)."""
+    initialize_server()
+    return app
+
+@app.before_request
+def ensure_worker_started():
+    if worker_pid != os.getpid():
+        start_worker()
 
 @app.route('/request-verification', methods=['POST'])
 @rate_limit('verification')
@@ -639,12 +2543,68 @@ def request_verification():
     if not MY_PRS_ID:
         return jsonify({"error": "Server not authenticated"}), 503
 
-    code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=16))
+    code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=VERIFICATION_CODE_LENGTH))
     return jsonify({
         "code": code,
         "targetPrsId": MY_PRS_ID
     })
 
+def wait_for_upstream(future, deadline, default):
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        future.cancel()
+        log("Verification deadline reached while waiting for eSchool", logging.WARNING)
+        return default
+
+def deep_scan_threads(threads, code, deadline):
+    futures = {
+        upstream_executor.submit(sync_thread_shared, thread.get('threadId'), thread.get('date')): thread.get('threadId')
+        for thread in inbox_indexer.changed_threads(threads, DEEP_SCAN_THREADS)
+    }
+
+    try:
+        for future in as_completed(futures, timeout=max(0, deadline - time.monotonic())):
+            future.result()
+            sender = inbox_indexer.lookup(code)
+            if sender:
+                log(f"  Found code in thread {futures[future]}!", logging.DEBUG)
+                return sender
+    except FutureTimeoutError:
+        log("Verification deadline reached during deep scan", logging.WARNING)
+    finally:
+        for future in futures:
+            future.cancel()
+
+    return None
+
+def issue_verified_token(data, verified_prs_id):
+    token = str(uuid.uuid4())
+    device_name = data.get('deviceName', 'Unknown device')
+    full_name = data.get('fullName')
+    grade_class = data.get('gradeClass')
+
+    conn = get_request_db()
+    if conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO verified_users (token, prs_id, device_name, full_name, grade_class)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (token, verified_prs_id, device_name, full_name, grade_class))
+            conn.commit()
+            cursor.close()
+            token_cache.put(token, (verified_prs_id, grade_class, full_name))
+            log(f"Verified user: {full_name} ({grade_class}) - prs_id: {verified_prs_id}")
+        except Exception as e:
+            log(f"DB Error: {e}", logging.ERROR)
+            return jsonify({"error": "Database error"}), 500
+
+    return jsonify({
+        "verified": True,
+        "token": token
+    })
+
 @app.route('/check-verification', methods=['POST'])
 @rate_limit('verification')
 def check_verification():
@@ -658,78 +2618,47 @@ def check_verification():
     if not expected_code:
         return jsonify({"error": "No code provided"}), 400
 
-    log(f"Checking for message with code: {expected_code} (Client Thread: {client_thread_id})")
+    log(f"Checking for message with code: {expected_code} (Client Thread: {client_thread_id})", logging.DEBUG)
 
-    verified_prs_id = None
+    verified_prs_id = inbox_indexer.lookup(expected_code)
+    if verified_prs_id:
+        log(f"Found code in inbox index! Sender: {verified_prs_id}", logging.DEBUG)
+        return issue_verified_token(data, verified_prs_id)
+
+    deadline = time.monotonic() + VERIFICATION_DEADLINE
+
+    threads_future = upstream_executor.submit(sync_threads_shared)
 
     if client_thread_id:
-        log(f"Strategy 1: Checking specific thread {client_thread_id}...")
-        messages = get_thread_messages(CURRENT_COOKIES, client_thread_id)
-        if messages:
-            log(f"  Got {len(messages)} messages from thread {client_thread_id}")
-        else:
-            log(f"  Failed to get messages from thread {client_thread_id} or empty")
+        log(f"Strategy 1: Checking specific thread {client_thread_id}...", logging.DEBUG)
+        messages = wait_for_upstream(upstream_executor.submit(sync_thread_shared, client_thread_id), deadline, [])
+        log(f"  Got {len(messages)} new messages from thread {client_thread_id}", logging.DEBUG)
 
-        for msg in messages:
-            if expected_code in msg.get('msg', ''):
-                verified_prs_id = msg.get('senderId')
-                log(f"Found code in thread {client_thread_id}! Sender: {verified_prs_id}")
-                break
+        verified_prs_id = inbox_indexer.lookup(expected_code)
+        if verified_prs_id:
+            log(f"Found code in thread {client_thread_id}! Sender: {verified_prs_id}", logging.DEBUG)
 
     threads = []
     if not verified_prs_id:
-        log("Strategy 2: Checking thread previews...")
-        threads = get_messages(CURRENT_COOKIES)
-        log(f"  Got {len(threads)} threads")
-        for thread in threads:
-            if expected_code in thread.get('preview', ''):
-                verified_prs_id = thread.get('imgObjId')
-                log(f"Found code in preview of thread with {thread.get('sender')}!")
-                break
+        log("Strategy 2: Checking thread previews...", logging.DEBUG)
+        threads = wait_for_upstream(threads_future, deadline, [])
+        log(f"  Got {len(threads)} updated threads", logging.DEBUG)
+
+        verified_prs_id = inbox_indexer.lookup(expected_code)
+        if verified_prs_id:
+            log(f"Found code in thread previews! Sender: {verified_prs_id}", logging.DEBUG)
+    else:
+        threads_future.cancel()
 
     if not verified_prs_id:
         if threads:
-            log("Strategy 3: Deep scanning top 5 threads...")
-            for i, thread in enumerate(threads[:5]):
-                t_id = thread.get('threadId')
-                if not t_id:
-                    continue
-
-                log(f"  Scanning thread {t_id} ({i+1}/5)...")
-                msgs = get_thread_messages(CURRENT_COOKIES, t_id)
-                for msg in msgs:
-                    if expected_code in msg.get('msg', ''):
-                        verified_prs_id = msg.get('senderId')
-                        log(f"  Found code in thread {t_id}!")
-                        break
-                if verified_prs_id:
-                    break
+            log(f"Strategy 3: Deep scanning up to {DEEP_SCAN_THREADS} updated threads...", logging.DEBUG)
+            verified_prs_id = deep_scan_threads(threads, expected_code, deadline)
         else:
-            log("Strategy 3 Skipped: No threads found in thread list.")
+            log("Strategy 3 Skipped: No threads found in thread list.", logging.DEBUG)
 
     if verified_prs_id:
-        token = str(uuid.uuid4())
-        device_name = data.get('deviceName', 'Unknown device')
-        full_name = data.get('fullName')
-        grade_class = data.get('gradeClass')
-
-        conn = get_db_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute(, (token, verified_prs_id, device_name, full_name, grade_class))
-                conn.commit()
-                cursor.close()
-                conn.close()
-                log(f"Verified user: {full_name} ({grade_class}) - prs_id: {verified_prs_id}")
-            except Exception as e:
-                log(f"DB Error: {e}")
-                return jsonify({"error": "Database error"}), 500
-
-        return jsonify({
-            "verified": True,
-            "token": token
-        })
+        return issue_verified_token(data, verified_prs_id)
 
     log("Verification failed: Code not found.")
     return jsonify({"verified": False})
@@ -743,24 +2672,26 @@ def revoke_token():
     if not token:
         return jsonify({"error": "No token provided"}), 400
 
-    log(f"Revoking token: {token}")
+    log(f"Revoking token: {token[:8]}...")
 
-    conn = get_db_connection()
+    conn = get_request_db()
     if conn:
         try:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM verified_users WHERE token = %s", (token,))
             rows_affected = cursor.rowcount
+            if rows_affected > 0:
+                bump_token_revocation_version(cursor)
             conn.commit()
             cursor.close()
-            conn.close()
+            token_cache.invalidate(token)
 
             if rows_affected > 0:
                 return jsonify({"success": True, "message": "Token revoked"})
             else:
                 return jsonify({"success": False, "message": "Token not found"}), 404
         except Exception as e:
-            log(f"DB Error: {e}")
+            log(f"DB Error: {e}", logging.ERROR)
             return jsonify({"error": "Database error"}), 500
 
     return jsonify({"error": "Database connection failed"}), 500
@@ -774,22 +2705,19 @@ def list_devices():
     if not token:
         return jsonify({"error": "No token provided"}), 401
 
-    conn = get_db_connection()
+    prs_id, _ = get_user_by_token(token)
+    if not prs_id:
+        return jsonify({"error": "Invalid token"}), 401
+
+    conn = get_request_db()
     if conn:
         try:
             cursor = conn.cursor()
 
-            cursor.execute("SELECT prs_id FROM verified_users WHERE token = %s", (token,))
-            row = cursor.fetchone()
-
-            if not row:
-                cursor.close()
-                conn.close()
-                return jsonify({"error": "Invalid token"}), 401
-
-            prs_id = row[0]
-
-            cursor.execute(, (prs_id,))
+            cursor.execute("""
+                SELECT token, device_name, created_at FROM verified_users
+                WHERE prs_id = %s ORDER BY created_at DESC
+            """, (prs_id,))
             results = cursor.fetchall()
 
             devices = []
@@ -797,17 +2725,16 @@ def list_devices():
                 devices.append({
                     "token": row[0],
                     "deviceName": row[1] or "Unknown device",
-                    "createdAt": row[2].isoformat() if row[2] else None,
+                    "createdAt": row[2],
                     "isCurrent": row[0] == token
                 })
 
             cursor.close()
-            conn.close()
 
             return jsonify({"devices": devices})
 
         except Exception as e:
-            log(f"DB Error: {e}")
+            log(f"DB Error: {e}", logging.ERROR)
             return jsonify({"error": "Database error"}), 500
 
     return jsonify({"error": "Database connection failed"}), 500
@@ -825,19 +2752,15 @@ def check_verified_users():
     if not ids_to_check or not isinstance(ids_to_check, list):
         return jsonify({"verifiedIds": []})
 
-    conn = get_db_connection()
+    requester_prs_id, _ = get_user_by_token(token)
+    if not requester_prs_id:
+        return jsonify({"error": "Invalid token"}), 401
+
+    conn = get_request_db()
     if conn:
         try:
             cursor = conn.cursor()
 
-            cursor.execute("SELECT prs_id FROM verified_users WHERE token = %s", (token,))
-            requester = cursor.fetchone()
-
-            if not requester:
-                cursor.close()
-                conn.close()
-                return jsonify({"error": "Invalid token"}), 401
-
             format_strings = ','.join(['%s'] * len(ids_to_check))
             query = f"SELECT DISTINCT prs_id FROM verified_users WHERE prs_id IN ({format_strings})"
 
@@ -847,37 +2770,90 @@ def check_verified_users():
             verified_ids = [row[0] for row in results]
 
             cursor.close()
-            conn.close()
 
             return jsonify({"verifiedIds": verified_ids})
 
         except Exception as e:
-            log(f"DB Error: {e}")
+            log(f"DB Error: {e}", logging.ERROR)
             return jsonify({"error": "Database error"}), 500
 
     return jsonify({"error": "Database connection failed"}), 500
 
-def get_user_by_token(token):
-    conn = get_db_connection()
+token_revocation_version = None
+token_revocation_checked_at = 0.0
+
+def bump_token_revocation_version(cursor):
+    cursor.execute("""
+        INSERT INTO token_revocations (id, version) VALUES (1, 1)
+        ON DUPLICATE KEY UPDATE version = version + 1
+    """)
+
+def check_token_revocations():
+    """Clear the token cache once a token was revoked in any worker.
+
+    token_cache is per process, so /revoke-token can only invalidate its own
+    worker's entry; the others notice the bumped version within
+    TOKEN_REVOCATION_CHECK_INTERVAL seconds.
+    """
+    global token_revocation_version, token_revocation_checked_at
+    now = time.monotonic()
+    if now - token_revocation_checked_at < TOKEN_REVOCATION_CHECK_INTERVAL:
+        return
+    token_revocation_checked_at = now
+
+    conn = get_request_db()
     if not conn:
-        return None, None
+        return
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT prs_id, grade_class FROM verified_users WHERE token = %s", (token,))
+        cursor.execute("SELECT version FROM token_revocations WHERE id = 1")
         row = cursor.fetchone()
         cursor.close()
-        conn.close()
-        if row:
-            return row[0], row[1]
-        return None, None
     except Exception as e:
-        log(f"Error getting user by token: {e}")
-        return None, None
+        log(f"Error checking token revocations: {e}", logging.ERROR)
+        return
+
+    version = row[0] if row else 0
+    if token_revocation_version is not None and version != token_revocation_version:
+        token_cache.clear()
+    token_revocation_version = version
+
+def lookup_token(token):
+    check_token_revocations()
+    user = token_cache.get(token)
+    if user:
+        return user
+
+    conn = get_request_db()
+    if not conn:
+        return None
+    try:
+        rows = prepared_statements.execute(conn, 'token_lookup', """
+            SELECT prs_id, grade_class, full_name FROM verified_users WHERE token = %s
+        """, (token,))
+        if rows:
+            row = rows[0]
+            user = (row[0], row[1], row[2])
+            token_cache.put(token, user)
+            return user
+        return None
+    except Exception as e:
+        log(f"Error getting user by token: {e}", logging.ERROR)
+        return None
 
-def get_homework_files(cursor, homework_id):
-    cursor.execute(, (homework_id,))
+def get_user_by_token(token):
+    user = lookup_token(token)
+    if user:
+        return user[0], user[1]
+    return None, None
+
+def get_homework_files(conn, homework_id):
+    rows = prepared_statements.execute(conn, 'homework_files', """
+        SELECT id, file_name, file_size, mime_type FROM custom_homework_files
+        WHERE homework_id = %s ORDER BY id
+    """, (homework_id,))
     files = []
-    for row in cursor.fetchall():
+    for row in rows:
         files.append({
             "id": row[0],
             "fileName": row[1],
@@ -886,6 +2862,64 @@ def get_homework_files(cursor, homework_id):
         })
     return files
 
+def get_homework_files_batch(conn, homework_ids):
+    files_by_homework = {hw_id: [] for hw_id in homework_ids}
+    if not homework_ids:
+        return files_by_homework
+
+    rows = []
+    for start in range(0, len(homework_ids), HOMEWORK_MAX_PAGE_SIZE):
+        chunk = homework_ids[start:start + HOMEWORK_MAX_PAGE_SIZE]
+        # Pad the IN list to the next power of two so a handful of prepared
+        # statements cover every page size; duplicate ids don't change the result.
+        bucket = 1 << (len(chunk) - 1).bit_length()
+        params = list(chunk) + [chunk[-1]] * (bucket - len(chunk))
+        format_strings = ','.join(['%s'] * bucket)
+        rows.extend(prepared_statements.execute(conn, f'homework_files_batch[{bucket}]', f"""
+            SELECT homework_id, id, file_name, file_size, mime_type FROM custom_homework_files
+            WHERE homework_id IN ({format_strings}) ORDER BY homework_id, id
+        """, params))
+    for row in rows:
+        files_by_homework[row[0]].append({
+            "id": row[1],
+            "fileName": row[2],
+            "fileSize": row[3],
+            "mimeType": row[4]
+        })
+    return files_by_homework
+
+def bump_homework_version(cursor, grade_class):
+    cursor.execute("""
+        INSERT INTO custom_homework_versions (grade_class, version) VALUES (%s, 1)
+        ON DUPLICATE KEY UPDATE version = version + 1
+    """, (grade_class,))
+
+def get_homework_version(cursor, grade_class):
+    cursor.execute("SELECT version FROM custom_homework_versions WHERE grade_class = %s", (grade_class,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def encode_homework_cursor(row, watermark):
+    payload = {
+        "k": [row[4].isoformat(), row[6].isoformat(), row[0]],
+        "w": watermark.isoformat() if watermark else None
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_homework_cursor(value):
+    """Return ((lesson_date, created_at, id), watermark) or None if malformed."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+        lesson_date, created_at, homework_id = payload["k"]
+        watermark = datetime.fromisoformat(payload["w"]) if payload["w"] else None
+        return (date.fromisoformat(lesson_date), datetime.fromisoformat(created_at), int(homework_id)), watermark
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return None
+
+def homework_list_etag(grade_class, version, prs_id, *params):
+    key = json.dumps([grade_class, version, prs_id, *params], default=str)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
 @app.route('/custom-homework/create', methods=['POST'])
 @rate_limit('default')
 def create_custom_homework():
@@ -899,74 +2933,49 @@ def create_custom_homework():
     if not subject or not lesson_date or not text:
         return jsonify({"error": "Missing required fields"}), 400
 
-    prs_id, grade_class = get_user_by_token(token)
-    if not prs_id:
+    user = lookup_token(token)
+    if not user:
         return jsonify({"error": "Invalid token"}), 401
+    prs_id, grade_class, author_full_name = user
     if not grade_class:
         return jsonify({"error": "User has no grade_class"}), 400
 
-    conn = get_db_connection()
+    files = request.files.getlist('files')
+    if len(files) > MAX_FILES_PER_HOMEWORK:
+        return jsonify({"error": f"Maximum {MAX_FILES_PER_HOMEWORK} files allowed"}), 400
+
+    conn = get_request_db()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT full_name FROM verified_users WHERE token = %s", (token,))
-        row = cursor.fetchone()
-        author_full_name = row[0] if row else "Unknown"
 
-        cursor.execute(, (prs_id, author_full_name, grade_class, subject, lesson_date, text))
+        cursor.execute("""
+            INSERT INTO custom_homework (author_prs_id, author_full_name, grade_class, subject, lesson_date, text)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (prs_id, author_full_name, grade_class, subject, lesson_date, text))
         homework_id = cursor.lastrowid
-        conn.commit()
-
-        files = request.files.getlist('files')
-        saved_files = []
 
-        if len(files) > MAX_FILES_PER_HOMEWORK:
-            cursor.execute("DELETE FROM custom_homework WHERE id = %s", (homework_id,))
-            conn.commit()
-            cursor.close()
-            conn.close()
-            return jsonify({"error": f"Maximum {MAX_FILES_PER_HOMEWORK} files allowed"}), 400
-
-        homework_folder = os.path.join(UPLOAD_FOLDER, grade_class, str(homework_id))
-        os.makedirs(homework_folder, exist_ok=True)
-
-        for file in files:
-            if file and file.filename:
-                if not allowed_file(file.filename):
-                    continue
-
-                file.seek(0, 2)
-                file_size = file.tell()
-                file.seek(0)
-
-                if file_size > MAX_FILE_SIZE:
-                    continue
-
-                original_name = secure_filename(file.filename)
-                unique_name = f"{uuid.uuid4().hex[:8]}_{original_name}"
-                file_path = os.path.join(homework_folder, unique_name)
-                file.save(file_path)
-
-                mime_type = file.content_type or 'application/octet-stream'
-
-                cursor.execute(, (homework_id, original_name, file_size, mime_type, file_path))
-
-                saved_files.append({
-                    "id": cursor.lastrowid,
-                    "fileName": original_name,
-                    "fileSize": file_size,
-                    "mimeType": mime_type
-                })
+        attachments = collect_uploads(files, MAX_FILES_PER_HOMEWORK)
+        insert_homework_files(cursor, homework_id, attachments)
+        for _, _, upload in attachments:
+            attachment_store.put(upload)
 
+        bump_homework_version(cursor, grade_class)
         conn.commit()
 
-        cursor.execute(, (homework_id,))
+        for _, _, upload in attachments:
+            attachment_store.settle(upload)
+
+        cursor.execute("""
+            SELECT id, subject, lesson_date, text, author_full_name, created_at
+            FROM custom_homework WHERE id = %s
+        """, (homework_id,))
         hw = cursor.fetchone()
+        saved_files = get_homework_files(conn, homework_id)
 
         cursor.close()
-        conn.close()
 
         log(f"Custom homework created: {homework_id} by {author_full_name} for {grade_class}")
 
@@ -975,18 +2984,18 @@ def create_custom_homework():
             "homework": {
                 "id": hw[0],
                 "subject": hw[1],
-                "lessonDate": hw[2].isoformat() if hw[2] else None,
+                "lessonDate": hw[2],
                 "text": hw[3],
                 "authorFullName": hw[4],
                 "authorPrsId": prs_id,
                 "isMine": True,
                 "files": saved_files,
-                "createdAt": hw[5].isoformat() if hw[5] else None
+                "createdAt": hw[5]
             }
         })
 
     except Exception as e:
-        log(f"Error creating homework: {e}")
+        log(f"Error creating homework: {e}", logging.ERROR)
         return jsonify({"error": "Database error"}), 500
 
 @app.route('/custom-homework/list', methods=['POST'])
@@ -996,6 +3005,17 @@ def list_custom_homework():
     token = data.get('token')
     date_from = data.get('date_from')
     date_to = data.get('date_to')
+    since = data.get('since')
+    page_cursor = data.get('cursor')
+
+    # Clients that predate pagination send neither limit nor cursor and
+    # expect the whole list, so only paginate when asked to.
+    limit = None
+    if 'limit' in data or page_cursor:
+        try:
+            limit = min(max(int(data.get('limit') or HOMEWORK_PAGE_SIZE), 1), HOMEWORK_MAX_PAGE_SIZE)
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid limit"}), 400
 
     if not token:
         return jsonify({"error": "No token provided"}), 401
@@ -1006,53 +3026,125 @@ def list_custom_homework():
     if not grade_class:
         return jsonify({"error": "User has no grade_class"}), 400
 
-    conn = get_db_connection()
+    if since:
+        try:
+            since = datetime.fromisoformat(since).replace(tzinfo=None)
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid since"}), 400
+        if since < datetime.now() - timedelta(days=HOMEWORK_TOMBSTONE_RETENTION_DAYS):
+            since = None
+
+    keyset = None
+    watermark = since
+    if page_cursor:
+        decoded = decode_homework_cursor(page_cursor)
+        if not decoded:
+            return jsonify({"error": "Invalid cursor"}), 400
+        keyset, watermark = decoded
+
+    conn = get_request_db()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
     try:
         cursor = conn.cursor()
 
-        query =
+        version = get_homework_version(cursor, grade_class)
+        etag = homework_list_etag(grade_class, version, prs_id, date_from, date_to, since, page_cursor, limit)
+        if request.if_none_match.contains_weak(etag):
+            cursor.close()
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        query = """
+            SELECT id, author_prs_id, author_full_name, subject, lesson_date, text, created_at, updated_at
+            FROM custom_homework WHERE grade_class = %s
+        """
         params = [grade_class]
+        variant = []
 
+        if since:
+            query += " AND updated_at >= %s"
+            params.append(since)
+            variant.append('since')
         if date_from:
             query += " AND lesson_date >= %s"
             params.append(date_from)
+            variant.append('from')
         if date_to:
             query += " AND lesson_date <= %s"
             params.append(date_to)
-
-        query += " ORDER BY lesson_date DESC, created_at DESC"
-
-        cursor.execute(query, tuple(params))
-        rows = cursor.fetchall()
+            variant.append('to')
+
+        if keyset:
+            lesson_date, created_at, last_id = keyset
+            query += """
+                AND (lesson_date < %s OR (lesson_date = %s AND
+                    (created_at < %s OR (created_at = %s AND id < %s))))
+            """
+            params.extend([lesson_date, lesson_date, created_at, created_at, last_id])
+            variant.append('after')
+
+        query += " ORDER BY lesson_date DESC, created_at DESC, id DESC"
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit + 1)
+            variant.append('page')
+
+        rows = prepared_statements.execute(conn, f"homework_list[{','.join(variant)}]", query, params)
+        has_more = limit is not None and len(rows) > limit
+        rows = rows[:limit]
+        files_by_homework = get_homework_files_batch(conn, [row[0] for row in rows])
 
         homework_list = []
         for row in rows:
             hw_id = row[0]
-            files = get_homework_files(cursor, hw_id)
+            files = files_by_homework[hw_id]
 
             homework_list.append({
                 "id": hw_id,
                 "authorPrsId": row[1],
                 "authorFullName": row[2],
                 "subject": row[3],
-                "lessonDate": row[4].isoformat() if row[4] else None,
+                "lessonDate": row[4],
                 "text": row[5],
                 "isMine": row[1] == prs_id,
                 "files": files,
-                "createdAt": row[6].isoformat() if row[6] else None,
-                "updatedAt": row[7].isoformat() if row[7] else None
+                "createdAt": row[6],
+                "updatedAt": row[7]
             })
 
+        deleted = []
+        if not keyset:
+            cursor.execute("SELECT MAX(updated_at) FROM custom_homework WHERE grade_class = %s", (grade_class,))
+            latest = cursor.fetchone()[0]
+            if latest and (watermark is None or latest > watermark):
+                watermark = latest
+
+            if since:
+                cursor.execute("""
+                    SELECT homework_id, deleted_at FROM custom_homework_tombstones
+                    WHERE grade_class = %s AND deleted_at >= %s
+                """, (grade_class, since))
+                for homework_id, deleted_at in cursor.fetchall():
+                    deleted.append(homework_id)
+                    watermark = max(watermark, deleted_at)
+
         cursor.close()
-        conn.close()
 
-        return jsonify({"homework": homework_list})
+        response = jsonify({
+            "homework": homework_list,
+            "deleted": deleted,
+            "full": since is None,
+            "watermark": watermark,
+            "nextCursor": encode_homework_cursor(rows[-1], watermark) if has_more else None
+        })
+        response.set_etag(etag)
+        return response
 
     except Exception as e:
-        log(f"Error listing homework: {e}")
+        log(f"Error listing homework: {e}", logging.ERROR)
         return jsonify({"error": "Database error"}), 500
 
 @app.route('/custom-homework/update', methods=['POST'])
@@ -1072,7 +3164,7 @@ def update_custom_homework():
     if not prs_id:
         return jsonify({"error": "Invalid token"}), 401
 
-    conn = get_db_connection()
+    conn = get_request_db()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
@@ -1083,80 +3175,68 @@ def update_custom_homework():
         row = cursor.fetchone()
         if not row:
             cursor.close()
-            conn.close()
             return jsonify({"error": "Homework not found"}), 404
         if row[0] != prs_id:
             cursor.close()
-            conn.close()
             return jsonify({"error": "Not authorized to edit this homework"}), 403
 
         hw_grade_class = row[1]
 
-        if text:
-            cursor.execute("UPDATE custom_homework SET text = %s WHERE id = %s", (text, homework_id))
-
+        ids_to_delete = set()
         if delete_file_ids:
             try:
-                ids_to_delete = json.loads(delete_file_ids)
-                for file_id in ids_to_delete:
-                    cursor.execute("SELECT storage_path FROM custom_homework_files WHERE id = %s AND homework_id = %s", (file_id, homework_id))
-                    file_row = cursor.fetchone()
-                    if file_row:
-                        if os.path.exists(file_row[0]):
-                            os.remove(file_row[0])
-
-                        cursor.execute("DELETE FROM custom_homework_files WHERE id = %s", (file_id,))
-            except json.JSONDecodeError:
+                ids_to_delete = {int(file_id) for file_id in json.loads(delete_file_ids)}
+            except (json.JSONDecodeError, TypeError, ValueError):
                 pass
 
-        files = request.files.getlist('files')
-
-        cursor.execute("SELECT COUNT(*) FROM custom_homework_files WHERE homework_id = %s", (homework_id,))
-        existing_count = cursor.fetchone()[0]
-
-        homework_folder = os.path.join(UPLOAD_FOLDER, hw_grade_class, str(homework_id))
-        os.makedirs(homework_folder, exist_ok=True)
-
-        saved_files = []
-        for file in files:
-            if existing_count + len(saved_files) >= MAX_FILES_PER_HOMEWORK:
-                break
-
-            if file and file.filename:
-                if not allowed_file(file.filename):
-                    continue
-
-                file.seek(0, 2)
-                file_size = file.tell()
-                file.seek(0)
-
-                if file_size > MAX_FILE_SIZE:
-                    continue
-
-                original_name = secure_filename(file.filename)
-                unique_name = f"{uuid.uuid4().hex[:8]}_{original_name}"
-                file_path = os.path.join(homework_folder, unique_name)
-                file.save(file_path)
+        # One read covers both the rows to delete and the remaining file count.
+        cursor.execute("SELECT id, storage_path, content_hash FROM custom_homework_files WHERE homework_id = %s", (homework_id,))
+        existing_files = cursor.fetchall()
+
+        legacy_paths = []
+        released_hashes = []
+        deleted_ids = []
+        for file_id, storage_path, content_hash in existing_files:
+            if file_id not in ids_to_delete:
+                continue
+            deleted_ids.append(file_id)
+            if content_hash:
+                released_hashes.append(content_hash)
+            else:
+                legacy_paths.append(storage_path)
 
-                mime_type = file.content_type or 'application/octet-stream'
+        if deleted_ids:
+            format_strings = ','.join(['%s'] * len(deleted_ids))
+            cursor.execute(f"DELETE FROM custom_homework_files WHERE id IN ({format_strings})", tuple(deleted_ids))
 
-                cursor.execute(, (homework_id, original_name, file_size, mime_type, file_path))
+        existing_count = len(existing_files) - len(deleted_ids)
+        attachments = collect_uploads(request.files.getlist('files'), MAX_FILES_PER_HOMEWORK - existing_count)
+        insert_homework_files(cursor, homework_id, attachments)
+        for _, _, upload in attachments:
+            attachment_store.put(upload)
 
-                saved_files.append({
-                    "id": cursor.lastrowid,
-                    "fileName": original_name,
-                    "fileSize": file_size,
-                    "mimeType": mime_type
-                })
+        if text or deleted_ids or attachments:
+            cursor.execute("""
+                UPDATE custom_homework SET text = COALESCE(%s, text), updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (text or None, homework_id))
+            bump_homework_version(cursor, hw_grade_class)
 
         conn.commit()
 
-        cursor.execute(, (homework_id,))
+        for _, _, upload in attachments:
+            attachment_store.settle(upload)
+        remove_legacy_files(legacy_paths)
+        attachment_store.release(conn, released_hashes)
+
+        cursor.execute("""
+            SELECT id, subject, lesson_date, text, author_full_name, author_prs_id, created_at, updated_at
+            FROM custom_homework WHERE id = %s
+        """, (homework_id,))
         hw = cursor.fetchone()
-        all_files = get_homework_files(cursor, homework_id)
+        all_files = get_homework_files(conn, homework_id)
 
         cursor.close()
-        conn.close()
 
         log(f"Custom homework updated: {homework_id}")
 
@@ -1165,19 +3245,19 @@ def update_custom_homework():
             "homework": {
                 "id": hw[0],
                 "subject": hw[1],
-                "lessonDate": hw[2].isoformat() if hw[2] else None,
+                "lessonDate": hw[2],
                 "text": hw[3],
                 "authorFullName": hw[4],
                 "authorPrsId": hw[5],
                 "isMine": True,
                 "files": all_files,
-                "createdAt": hw[6].isoformat() if hw[6] else None,
-                "updatedAt": hw[7].isoformat() if hw[7] else None
+                "createdAt": hw[6],
+                "updatedAt": hw[7]
             }
         })
 
     except Exception as e:
-        log(f"Error updating homework: {e}")
+        log(f"Error updating homework: {e}", logging.ERROR)
         return jsonify({"error": "Database error"}), 500
 
 @app.route('/custom-homework/delete', methods=['POST'])
@@ -1196,7 +3276,7 @@ def delete_custom_homework():
     if not prs_id:
         return jsonify({"error": "Invalid token"}), 401
 
-    conn = get_db_connection()
+    conn = get_request_db()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
@@ -1207,38 +3287,41 @@ def delete_custom_homework():
         row = cursor.fetchone()
         if not row:
             cursor.close()
-            conn.close()
             return jsonify({"error": "Homework not found"}), 404
         if row[0] != prs_id:
             cursor.close()
-            conn.close()
             return jsonify({"error": "Not authorized to delete this homework"}), 403
 
         grade_class = row[1]
 
-        cursor.execute("SELECT storage_path FROM custom_homework_files WHERE homework_id = %s", (homework_id,))
+        cursor.execute("SELECT storage_path, content_hash FROM custom_homework_files WHERE homework_id = %s", (homework_id,))
         files = cursor.fetchall()
 
-        for file_row in files:
-            if file_row[0] and os.path.exists(file_row[0]):
-                os.remove(file_row[0])
-
-        homework_folder = os.path.join(UPLOAD_FOLDER, grade_class, str(homework_id))
-        if os.path.exists(homework_folder) and not os.listdir(homework_folder):
-            os.rmdir(homework_folder)
-
         cursor.execute("DELETE FROM custom_homework WHERE id = %s", (homework_id,))
+        cursor.execute("""
+            INSERT INTO custom_homework_tombstones (homework_id, grade_class) VALUES (%s, %s)
+        """, (homework_id, grade_class))
+        cursor.execute("""
+            DELETE FROM custom_homework_tombstones WHERE grade_class = %s AND deleted_at < %s
+        """, (grade_class, datetime.now() - timedelta(days=HOMEWORK_TOMBSTONE_RETENTION_DAYS)))
+        bump_homework_version(cursor, grade_class)
         conn.commit()
 
         cursor.close()
-        conn.close()
+
+        remove_legacy_files([file_row[0] for file_row in files if not file_row[1]])
+        attachment_store.release(conn, [file_row[1] for file_row in files if file_row[1]])
+
+        homework_folder = os.path.join(UPLOAD_FOLDER, grade_class, str(homework_id))
+        if os.path.exists(homework_folder) and not os.listdir(homework_folder):
+            os.rmdir(homework_folder)
 
         log(f"Custom homework deleted: {homework_id}")
 
         return jsonify({"success": True})
 
     except Exception as e:
-        log(f"Error deleting homework: {e}")
+        log(f"Error deleting homework: {e}", logging.ERROR)
         return jsonify({"error": "Database error"}), 500
 
 @app.route('/custom-homework/file/<int:file_id>', methods=['GET'])
@@ -1253,23 +3336,22 @@ def download_custom_homework_file(file_id):
     if not prs_id:
         return jsonify({"error": "Invalid token"}), 401
 
-    conn = get_db_connection()
+    conn = get_request_db()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
     try:
-        cursor = conn.cursor()
-
-        cursor.execute(, (file_id,))
-        row = cursor.fetchone()
-
-        cursor.close()
-        conn.close()
-
-        if not row:
+        rows = prepared_statements.execute(conn, 'file_download', """
+            SELECT f.storage_path, f.file_name, f.mime_type, f.content_hash, h.grade_class
+            FROM custom_homework_files f
+            JOIN custom_homework h ON f.homework_id = h.id
+            WHERE f.id = %s
+        """, (file_id,))
+
+        if not rows:
             return jsonify({"error": "File not found"}), 404
 
-        file_path, file_name, mime_type, hw_grade_class = row
+        file_path, file_name, mime_type, content_hash, hw_grade_class = rows[0]
 
         if hw_grade_class != grade_class:
             return jsonify({"error": "Not authorized to download this file"}), 403
@@ -1277,17 +3359,50 @@ def download_custom_homework_file(file_id):
         if not os.path.exists(file_path):
             return jsonify({"error": "File not found on server"}), 404
 
-        return send_file(
-            file_path,
-            mimetype=mime_type or 'application/octet-stream',
-            as_attachment=True,
-            download_name=file_name
-        )
+        return attachment_response(file_path, file_name, mime_type, content_hash)
 
     except Exception as e:
-        log(f"Error downloading file: {e}")
+        log(f"Error downloading file: {e}", logging.ERROR)
         return jsonify({"error": "Server error"}), 500
 
+@app.after_request
+def compress_response(response):
+    return response_compressor.compress(response)
+
+def collect_metrics():
+    return {
+        "db_pool": db_pool.snapshot(),
+        "token_cache": token_cache.snapshot(),
+        "rate_limiter": rate_limiter.snapshot(),
+        "upstream": upstream.snapshot(),
+        "session": session_manager.snapshot(),
+        "inbox_indexer": inbox_indexer.snapshot(),
+        "poller_election": poller_election.snapshot(),
+        "attachment_store": attachment_store.snapshot(),
+        "compression": response_compressor.snapshot(),
+        "prepared_statements": prepared_statements.snapshot(),
+        "upstream_cache": {
+            **upstream_cache.snapshot(),
+            "single_flight": upstream_flight.snapshot()
+        },
+        "log": {
+            "queued": log_handler.queue.qsize(),
+            "dropped": log_handler.dropped
+        }
+    }
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not METRICS_TOKEN or request.headers.get('X-Metrics-Token') != METRICS_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(collect_metrics())
+
 if __name__ == '__main__':
     initialize_server()
-    app.run(host='0.0.0.0', port=20001)
\ No newline at end of file
+    start_worker()
+    if ASYNC_MODE == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        log("Serving in gevent mode on port 20001")
+        WSGIServer(('0.0.0.0', 20001), app, log=None).serve_forever()
+    else:
+        app.run(host='0.0.0.0', port=20001)
\ No newline at end of file
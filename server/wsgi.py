@@ -0,0 +1,13 @@
+"""WSGI entry point.
+
+gunicorn:  gunicorn -c gunicorn.conf.py
+uwsgi:     uwsgi --ini uwsgi.ini
+
+uWSGI (lazy-apps) imports this module in each worker after the fork and
+has no post_worker_init hook, so the worker's background threads and the
+eSchool login start here rather than on the first request.
+"""
+from server import create_app, start_worker
+
+application = create_app()
+start_worker()